@@ -2,6 +2,8 @@
 
 from .polylogger import LOG_HANDLER, LOGGER
 from .polyinterface import Interface, Node, Controller, unload_interface, get_network_interface
+from .polymetrics import METRICS
+from .polytransport import Transport, LoopbackTransport
 
 __version__ = '3.0.0'
 __description__ = 'UDI PG3 Interface'
@@ -10,4 +12,14 @@ __author__ = 'James Milne'
 __authoremail__ = 'milne.james@gmail.com'
 __license__ = 'MIT'
 
-LOGGER.info('{} {} Starting...'.format(__description__, __version__))
+
+def __getattr__(name):
+    # polyasync pulls in asyncio and polyshard multiprocessing, only
+    # import them when asked for
+    if name in ('AsyncInterface', 'AsyncController'):
+        from . import polyasync
+        return getattr(polyasync, name)
+    if name == 'ShardedController':
+        from . import polyshard
+        return polyshard.ShardedController
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
@@ -0,0 +1,190 @@
+"""
+asyncio variants of Interface and Controller.
+
+Input from Polyglot is dispatched on a single event loop. Node and
+Controller handlers (runCmd command functions, query, status, shortPoll,
+longPoll, start, delete) may be plain functions or 'async def' coroutines;
+coroutines are awaited on the loop. Handlers for the same node address run
+in order, different nodes run concurrently.
+
+Interface.send and Node.setDriver never block and are thread safe, so they
+can be called directly from coroutines running on the loop.
+"""
+
+import asyncio
+import functools
+import inspect
+from threading import Lock, Thread
+import time
+from .polylogger import LOGGER
+from .polyinterface import Interface, Controller
+
+
+async def _resolve(result):
+    """ Await result if a handler returned an awaitable. """
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+class AsyncInterface(Interface):
+    """
+    Interface that hands input straight to an event loop once a handler
+    is set, instead of going through inQueue and the Controller thread.
+    """
+
+    def __init__(self, envVar=None, transport=None):
+        Interface.__init__(self, envVar, transport)
+        self._inputLock = Lock()
+        self._inputHandler = None
+
+    def setInputHandler(self, loop, handler):
+        """
+        Deliver all input to handler(command) on loop. Anything queued
+        before the handler was set is delivered first.
+        """
+        with self._inputLock:
+            self.loop = loop
+            self._inputHandler = handler
+            while not self.inQueue.empty():
+                loop.call_soon_threadsafe(handler, self.inQueue.get_nowait())
+                self.inQueue.task_done()
+
+    def input(self, command):
+        with self._inputLock:
+            if self._inputHandler is None:
+                Interface.input(self, command)
+            elif not self._coalescePoll(command):
+                self.loop.call_soon_threadsafe(self._inputHandler, command)
+
+
+class AsyncController(Controller):
+    """
+    Controller running its handlers on an asyncio event loop.
+
+    :param poly: AsyncInterface (or Interface, input is then bridged from
+        inQueue by the Controller thread).
+    :param loop: Event loop to use, a new one is created if None. Run it
+        with runForever() or run it yourself.
+    """
+
+    def __init__(self, poly, name='Controller', loop=None):
+        self.loop = loop or asyncio.new_event_loop()
+        self._tails = {}
+        Controller.__init__(self, poly, name)
+
+    def _startThreads(self):
+        self._threads['ns'] = Thread(
+            target=self._scheduleStart, name='NodeServer')
+        self._threads['ns'].daemon = True
+        if isinstance(self.poly, AsyncInterface):
+            self.poly.setInputHandler(self.loop, self._onInput)
+        else:
+            self._threads['input'].daemon = True
+            self._threads['input'].start()
+
+    def _scheduleStart(self):
+        self.loop.call_soon_threadsafe(self._spawn, self.start)
+
+    def _spawn(self, fn, *args):
+        task = self.loop.create_task(self._call(fn, *args))
+        return task
+
+    async def _call(self, fn, *args):
+        try:
+            return await _resolve(fn(*args))
+        except Exception as err:
+            LOGGER.error('{} failed: {}'.format(
+                getattr(fn, '__name__', fn), err), exc_info=True)
+
+    def _parseInput(self):
+        while True:
+            input = self.poly.inQueue.get()
+            self.loop.call_soon_threadsafe(self._onInput, input)
+            self.poly.inQueue.task_done()
+
+    def _onInput(self, input):
+        for key in input:
+            if isinstance(input[key], list):
+                for item in input[key]:
+                    self._submit(key, item)
+            else:
+                self._submit(key, input[key])
+
+    def _submit(self, key, item):
+        """
+        Start a task for the input, chained after the previous task for the
+        same node address so per node order is kept.
+        """
+        address = item.get('address') if isinstance(item, dict) else None
+        tail = address or key
+        task = self.loop.create_task(
+            self._runInput(self._tails.get(tail), key, item))
+        self._tails[tail] = task
+        task.add_done_callback(functools.partial(self._inputDone, tail))
+
+    def _inputDone(self, tail, task):
+        if self._tails.get(tail) is task:
+            del self._tails[tail]
+
+    async def _runInput(self, previous, key, item):
+        if previous is not None:
+            await asyncio.wait([previous])
+        started = time.time()
+        try:
+            await self._handleInputAsync(key, item)
+        except Exception as err:
+            LOGGER.error('_handleInputAsync: {} failed: {}'.format(
+                key, err), exc_info=True)
+        self._handlerTimer(key).observe(time.time() - started)
+
+    async def _handleInputAsync(self, key, item):
+        if key == 'command':
+            if item['address'] in self.nodes:
+                try:
+                    await _resolve(self.nodes[item['address']].runCmd(item))
+                except (Exception) as err:
+                    LOGGER.error('_parseInput: failed {}.runCmd({}) {}'.format(
+                        item['address'], item.get('command'), err), exc_info=True)
+            else:
+                LOGGER.error('_parseInput: received command {} for a node that is not in memory: {}'.format(
+                    item.get('command'), item['address']))
+        elif key == 'addnode':
+            try:
+                await _resolve(self._handleResult(item))
+            finally:
+                self._addDone(item)
+        elif key == 'delete':
+            self.poly.stop()
+            await _resolve(self.delete())
+        elif key in ('shortPoll', 'longPoll'):
+            self.poly._pollStarted(key)
+            if not self._localPolls:
+                await self._pollAsync(key)
+        elif key == 'query':
+            if item['address'] in self.nodes:
+                await _resolve(self.nodes[item['address']].query())
+            elif item['address'] == 'all':
+                await _resolve(self.query())
+        elif key == 'status':
+            if item['address'] in self.nodes:
+                await _resolve(self.nodes[item['address']].status())
+            elif item['address'] == 'all':
+                await _resolve(self.status())
+
+    async def _pollAsync(self, key):
+        started = time.time()
+        try:
+            return await _resolve(getattr(self, key)())
+        finally:
+            self._pollStats[key].record(time.time() - started)
+
+    def _poll(self, key):
+        """ Polls from the local poll scheduler run on the loop too. """
+        return asyncio.run_coroutine_threadsafe(
+            self._pollAsync(key), self.loop).result()
+
+    def runForever(self):
+        """ Run the event loop in the calling thread. """
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
@@ -0,0 +1,41 @@
+"""
+Cache of values derived from files, such as rendered markdown or parsed
+JSON, reloaded only when a file's modification time or size changes.
+"""
+
+import os
+from threading import Lock
+
+
+class FileCache(object):
+    """
+    Maps a path to (mtime, size, value). get() calls loader(path) only when
+    the file changed since it was last loaded. Values are shared, callers
+    that modify them must copy them first.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = {}
+        self.stats = {'hits': 0, 'loads': 0}
+
+    def get(self, path, loader):
+        stat = os.stat(path)
+        key = (getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == key and entry[1] == loader:
+                self.stats['hits'] += 1
+                return entry[2]
+        value = loader(path)
+        with self._lock:
+            self._entries[path] = (key, loader, value)
+            self.stats['loads'] += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+FILE_CACHE = FileCache()
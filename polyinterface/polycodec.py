@@ -0,0 +1,93 @@
+"""
+JSON codecs used to encode and decode MQTT payloads.
+
+getCodec() picks orjson or ujson when they are installed and falls back to
+the standard library json module. Every codec accepts bytes or str when
+decoding, so payloads can be decoded without an intermediate decode().
+"""
+
+import json
+from .polylogger import LOGGER
+
+
+class JsonCodec(object):
+    """ Standard library json. """
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    orjson. Objects orjson refuses (non string keys, very large integers,
+    unknown types) are encoded with the standard library instead.
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj):
+        try:
+            return self._orjson.dumps(obj)
+        except TypeError:
+            return json.dumps(obj)
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+
+class UjsonCodec(JsonCodec):
+    """ ujson. """
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, obj):
+        try:
+            return self._ujson.dumps(obj)
+        except (TypeError, OverflowError):
+            return json.dumps(obj)
+
+    def loads(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return self._ujson.loads(data)
+
+
+CODECS = {
+    'orjson': OrjsonCodec,
+    'ujson': UjsonCodec,
+    'json': JsonCodec,
+}
+
+# Order tried when no codec is selected
+AUTO_ORDER = ['orjson', 'ujson', 'json']
+
+
+def getCodec(name=None):
+    """
+    Return a codec instance by name ('orjson', 'ujson' or 'json'). None or
+    'auto' selects the fastest one available. A codec that can't be loaded
+    falls back to the standard library json.
+    """
+    if name in (None, '', 'auto'):
+        for candidate in AUTO_ORDER:
+            try:
+                return CODECS[candidate]()
+            except ImportError:
+                continue
+    try:
+        return CODECS[name]()
+    except KeyError:
+        LOGGER.error('Unknown JSON codec {}, using json'.format(name))
+    except ImportError:
+        LOGGER.error('JSON codec {} is not installed, using json'.format(name))
+    return JsonCodec()
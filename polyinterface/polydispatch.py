@@ -0,0 +1,142 @@
+"""
+Keyed thread pool used by the Controller to run input handlers in parallel
+while keeping the handlers for any one key (node address) in order.
+"""
+
+from collections import deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from threading import Thread, Condition, Event
+import time
+from .polylogger import LOGGER
+
+
+class KeyedDispatcher(object):
+    """
+    Runs submitted jobs on a bounded pool of worker threads. Jobs sharing
+    a key run one at a time in submission order, jobs with different keys
+    run concurrently.
+
+    :param workers: Number of worker threads.
+    :param timeout: Default seconds a job may run before it is reported as
+        timed out. Python threads can't be interrupted so the job keeps
+        running, it is logged and counted in stats(). None disables it.
+    """
+
+    def __init__(self, workers, timeout=None, name='Dispatch'):
+        self.workers = max(1, int(workers))
+        self.timeout = timeout
+        self.name = name
+        self._lock = Condition()
+        self._ready = queue.Queue()
+        self._pending = {}
+        self._active = {}
+        self._stopped = Event()
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'timeouts': 0,
+            'queued': 0,
+            'maxQueued': 0,
+        }
+        self._threads = []
+        for i in range(self.workers):
+            thread = Thread(target=self._worker,
+                            name='{}-{}'.format(name, i + 1))
+            thread.daemon = True
+            self._threads.append(thread)
+            thread.start()
+        self._watchdog = Thread(target=self._watch,
+                                name='{}-watchdog'.format(name))
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Queue fn(*args) to run after every job already submitted for key.
+        A 'timeout' keyword overrides the default timeout for this job.
+        """
+        timeout = kwargs.pop('timeout', self.timeout)
+        job = (fn, args, kwargs, timeout)
+        with self._lock:
+            jobs = self._pending.get(key)
+            schedule = jobs is None
+            if schedule:
+                jobs = self._pending[key] = deque()
+            jobs.append(job)
+            self._stats['submitted'] += 1
+            self._stats['queued'] += 1
+            if self._stats['queued'] > self._stats['maxQueued']:
+                self._stats['maxQueued'] = self._stats['queued']
+        if schedule:
+            self._ready.put(key)
+
+    def waitIdle(self):
+        """
+        Wait until a worker is free: fewer keys have jobs running or ready
+        to run than there are workers. Jobs queued behind a running job of
+        their key don't take a worker.
+        """
+        with self._lock:
+            while len(self._pending) >= self.workers and not self._stopped.is_set():
+                self._lock.wait()
+
+    def stats(self):
+        """ Snapshot of queue depth and job counters. """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['workers'] = self.workers
+            stats['keys'] = len(self._pending)
+            stats['active'] = len(self._active)
+        return stats
+
+    def stop(self):
+        """ Stop the workers once the jobs already scheduled are done. """
+        self._stopped.set()
+        with self._lock:
+            self._lock.notify_all()
+        for _ in self._threads:
+            self._ready.put(None)
+
+    def _worker(self):
+        while True:
+            key = self._ready.get()
+            if key is None:
+                break
+            with self._lock:
+                fn, args, kwargs, timeout = self._pending[key].popleft()
+                self._stats['queued'] -= 1
+                self._active[key] = [time.time(), timeout, False]
+            try:
+                fn(*args, **kwargs)
+                failed = False
+            except Exception as err:
+                failed = True
+                LOGGER.error('{}: job for {} failed: {}'.format(
+                    self.name, key, err), exc_info=True)
+            with self._lock:
+                del self._active[key]
+                self._stats['failed' if failed else 'completed'] += 1
+                if self._pending[key]:
+                    reschedule = True
+                else:
+                    del self._pending[key]
+                    reschedule = False
+                    self._lock.notify_all()
+            if reschedule:
+                self._ready.put(key)
+
+    def _watch(self):
+        while not self._stopped.wait(1):
+            now = time.time()
+            with self._lock:
+                for key, active in self._active.items():
+                    started, timeout, reported = active
+                    if timeout and not reported and now - started > timeout:
+                        active[2] = True
+                        self._stats['timeouts'] += 1
+                        LOGGER.warning('{}: job for {} still running after {}s'.format(
+                            self.name, key, timeout))
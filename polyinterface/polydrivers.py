@@ -0,0 +1,228 @@
+"""
+Compact driver state for nodes with many instances.
+
+A DriverSchema is computed once per Node class from its class-level drivers
+list and stamps out the per node copies of it. With compactDrivers each node
+then keeps its current and last reported values and uoms in a DriverStore
+(parallel lists indexed by the schema position) instead of two deep copied
+lists of dictionaries. DriverListView and DriverView make the store look
+like the usual list of {'driver', 'value', 'uom'} dictionaries.
+"""
+
+from copy import deepcopy
+try:
+    from collections.abc import Mapping, MutableMapping, Sequence
+except ImportError:
+    from collections import Mapping, MutableMapping, Sequence
+
+SCALAR_TYPES = (str, int, float, bool, type(None))
+
+
+def driverValueChanged(old, new):
+    """
+    True if a driver value changed. Values of the same type are compared
+    directly, anything else falls back to comparing their string form which
+    is what Polyglot receives.
+    """
+    if type(old) is type(new):
+        return old != new
+    return str(old) != str(new)
+
+
+def withinDeadband(old, new, absolute=None, percent=None):
+    """
+    True if new differs from old by no more than the absolute or percent
+    (of old) deadband. Values that aren't numbers are never within it.
+    """
+    try:
+        delta = abs(float(new) - float(old))
+    except (TypeError, ValueError):
+        return False
+    if absolute is not None and delta <= absolute:
+        return True
+    if percent is not None and delta <= abs(float(old)) * percent / 100.0:
+        return True
+    return False
+
+
+def copyValue(value):
+    """ Copy a driver value, skipping the deepcopy for plain scalars. """
+    if isinstance(value, SCALAR_TYPES):
+        return value
+    return deepcopy(value)
+
+
+class DriverSchema(object):
+    """
+    Driver layout of a Node class: codes, code -> position index, default
+    values and uoms, and any extra keys of the class-level driver entries.
+    """
+    __slots__ = ('source', 'codes', 'index', 'values', 'uoms', 'extras', 'shallow')
+
+    _cache = {}
+
+    def __init__(self, drivers):
+        self.source = drivers
+        self.codes = tuple(d['driver'] for d in drivers)
+        self.index = {}
+        for pos, code in enumerate(self.codes):
+            self.index.setdefault(code, pos)
+        self.values = tuple(deepcopy(d.get('value')) for d in drivers)
+        self.uoms = tuple(d.get('uom') for d in drivers)
+        self.extras = tuple(
+            dict((k, v) for k, v in d.items()
+                 if k not in ('driver', 'value', 'uom'))
+            for d in drivers)
+        # Entries holding only scalars can be copied with dict.copy()
+        self.shallow = all(isinstance(v, SCALAR_TYPES)
+                           for d in drivers for v in d.values())
+
+    def stamp(self):
+        """
+        A new list of driver dictionaries equal to the class-level list,
+        without a deepcopy when every entry only holds scalars.
+        """
+        if self.shallow:
+            return [d.copy() for d in self.source]
+        return deepcopy(self.source)
+
+    @classmethod
+    def forClass(cls, nodeClass):
+        """
+        Return the schema of a Node class, computing it on first use or when
+        the class-level drivers list has been replaced.
+        """
+        schema = cls._cache.get(nodeClass)
+        if schema is None or schema.source is not nodeClass.drivers:
+            schema = cls._cache[nodeClass] = cls(nodeClass.drivers)
+        return schema
+
+
+class DriverStore(object):
+    """
+    Current and last reported value/uom of every driver of one node, stored
+    as parallel lists in schema order.
+    """
+    __slots__ = ('schema', 'values', 'uoms', 'reportedValues', 'reportedUoms')
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.values = list(schema.values)
+        self.uoms = list(schema.uoms)
+        self.reportedValues = list(schema.values)
+        self.reportedUoms = list(schema.uoms)
+
+    def update(self, drivers):
+        """ Take the last reported values from a list of driver dicts. """
+        index = self.schema.index
+        for d in drivers:
+            pos = index.get(d['driver'])
+            if pos is not None:
+                self.reportedValues[pos] = copyValue(d['value'])
+                self.reportedUoms[pos] = d['uom']
+
+    def view(self, reported=False):
+        return DriverListView(self, reported)
+
+
+class DriverView(MutableMapping):
+    """
+    Dictionary view of one driver in a DriverStore. 'value' and 'uom' can be
+    set, 'driver' and any extra keys are read only.
+    """
+    __slots__ = ('_store', '_pos', '_reported')
+
+    def __init__(self, store, pos, reported=False):
+        self._store = store
+        self._pos = pos
+        self._reported = reported
+
+    def __getitem__(self, key):
+        store = self._store
+        if key == 'value':
+            values = store.reportedValues if self._reported else store.values
+            return values[self._pos]
+        if key == 'uom':
+            uoms = store.reportedUoms if self._reported else store.uoms
+            return uoms[self._pos]
+        if key == 'driver':
+            return store.schema.codes[self._pos]
+        return store.schema.extras[self._pos][key]
+
+    def __setitem__(self, key, value):
+        store = self._store
+        if key == 'value':
+            values = store.reportedValues if self._reported else store.values
+            values[self._pos] = value
+        elif key == 'uom':
+            uoms = store.reportedUoms if self._reported else store.uoms
+            uoms[self._pos] = value
+        else:
+            raise KeyError('{} is read only'.format(key))
+
+    def __delitem__(self, key):
+        raise KeyError('{} is read only'.format(key))
+
+    def __iter__(self):
+        yield 'driver'
+        yield 'value'
+        yield 'uom'
+        for key in self._store.schema.extras[self._pos]:
+            yield key
+
+    def __len__(self):
+        return 3 + len(self._store.schema.extras[self._pos])
+
+    def __eq__(self, other):
+        if isinstance(other, Mapping):
+            return dict(self) == dict(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __deepcopy__(self, memo):
+        return deepcopy(dict(self), memo)
+
+
+class DriverListView(Sequence):
+    """
+    Read only list view of all drivers in a DriverStore. Items are
+    DriverView objects, deepcopy() returns plain dictionaries.
+    """
+    __slots__ = ('_store', '_reported')
+
+    def __init__(self, store, reported=False):
+        self._store = store
+        self._reported = reported
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return [self[i] for i in range(*pos.indices(len(self)))]
+        if pos < 0:
+            pos += len(self)
+        if not 0 <= pos < len(self):
+            raise IndexError('driver index out of range')
+        return DriverView(self._store, pos, self._reported)
+
+    def __len__(self):
+        return len(self._store.schema.codes)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, DriverListView)):
+            return [dict(d) for d in self] == [dict(d) for d in other]
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return repr([dict(d) for d in self])
+
+    def __deepcopy__(self, memo):
+        return [deepcopy(dict(d), memo) for d in self]
@@ -5,16 +5,14 @@ by Einstein.42 (James Milne) milne.james@gmail.com
 """
 
 import warnings
+from collections import OrderedDict, deque
 from copy import deepcopy
 # from dotenv import load_dotenv
 import json
-import ssl
 import logging
 import __main__ as main
-import markdown2
 import os
 from os.path import join, expanduser
-import paho.mqtt.client as mqtt
 try:
     import queue
 except ImportError:
@@ -23,12 +21,23 @@ import re
 import sys
 import select
 import base64
+from concurrent import futures
+import functools
+import hashlib
 import random
 import string
-from threading import Thread, current_thread
+from threading import Thread, Timer, Event, Lock, RLock, current_thread
 import time
-import netifaces
-from .polylogger import LOGGER
+from .polylogger import LOGGER, LOG_HANDLER
+from .polycodec import getCodec
+from .polydispatch import KeyedDispatcher
+from .polypoll import PollScheduler, PollStats
+from .polyqueue import PriorityInputQueue
+from .polyrequests import PendingRequests, RequestError
+from .polycache import FILE_CACHE
+from .polymetrics import METRICS
+from .polytransport import pahoTransport, MQTT_ERR_NO_CONN
+from .polydrivers import DriverSchema, DriverStore, driverValueChanged, copyValue, withinDeadband
 
 DEBUG = False
 PY2 = sys.version_info[0] == 2
@@ -61,6 +70,7 @@ def get_network_interface(interface='default'):
 
     :param interface: The interface name to check, default grabs
     """
+    import netifaces
     # Get the default gateway
     gws = netifaces.gateways()
     LOGGER.debug("gws: {}".format(gws))
@@ -76,6 +86,16 @@ def get_network_interface(interface='default'):
     return {'addr': False, 'broadcast': False, 'netmask': False}
 
 
+def _renderMarkdown(fileName):
+    import markdown2
+    return markdown2.markdown_path(fileName)
+
+
+def _loadJson(fileName):
+    with open(fileName) as data:
+        return json.load(data)
+
+
 def random_string(length):
     letters_and_digits = string.ascii_letters + string.digits
     result_str = ''.join((random.choice(letters_and_digits)
@@ -83,6 +103,28 @@ def random_string(length):
     return result_str
 
 
+class ReconnectPolicy(object):
+    """
+    Exponential backoff with full jitter for MQTT connects and reconnects.
+    The delay before attempt n (from 0) is a random value between 0 and
+    min(maxDelay, initialDelay * multiplier ** n). maxAttempts of None
+    retries forever.
+    """
+
+    def __init__(self, initialDelay=1, maxDelay=60, multiplier=2, maxAttempts=None):
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.multiplier = multiplier
+        self.maxAttempts = maxAttempts
+
+    def delay(self, attempt):
+        ceiling = min(self.maxDelay, self.initialDelay * (self.multiplier ** attempt))
+        return random.uniform(0, ceiling)
+
+    def shouldRetry(self, attempt):
+        return self.maxAttempts is None or attempt < self.maxAttempts
+
+
 def init_interface():
     sys.stdout = LoggerWriter(LOGGER.debug)
     sys.stderr = LoggerWriter(LOGGER.error)
@@ -127,6 +169,7 @@ def init_interface():
 def unload_interface():
     sys.stdout = sys.__stdout__
     sys.stderr = sys.__stderr__
+    LOG_HANDLER.disable_queue()
     LOGGER.handlers = []
 
 
@@ -134,28 +177,84 @@ class Interface(object):
 
     CUSTOM_CONFIG_DOCS_FILE_NAME = 'POLYGLOT_CONFIG.md'
     SERVER_JSON_FILE_NAME = 'server.json'
+    # Outbound 'set' batching. Items are held for up to SEND_BATCH_WINDOW
+    # seconds (or until SEND_BATCH_SIZE items are pending) and published as
+    # a single message. A window of 0 disables batching.
+    SEND_BATCH_WINDOW = 0
+    SEND_BATCH_SIZE = 100
+    SEND_BATCH_TYPES = ['status']
+    # saveCustom() waits CUSTOM_SAVE_DELAY seconds so successive saves of a
+    # key are sent once. 0 sends right away. Unchanged values are not resent.
+    CUSTOM_SAVE_DELAY = 0
+    # JSON codec for MQTT payloads: 'orjson', 'ujson', 'json' or None to use
+    # the fastest one installed. The PG3_JSON_CODEC environment variable
+    # overrides it.
+    JSON_CODEC = None
+    # While MQTT is disconnected the latest value of each driver (up to
+    # OFFLINE_STATE_SIZE) and other messages in order (up to
+    # OFFLINE_BUFFER_SIZE, oldest dropped first) are kept and sent after
+    # reconnecting, driver values in messages of OFFLINE_REPLAY_CHUNK items.
+    OFFLINE_STATE_SIZE = 10000
+    OFFLINE_BUFFER_SIZE = 1000
+    OFFLINE_REPLAY_CHUNK = 100
+    # Backoff used by both the initial connect and reconnects, see
+    # ReconnectPolicy. RECONNECT_MAX_ATTEMPTS of None never gives up.
+    RECONNECT_INITIAL_DELAY = 1
+    RECONNECT_MAX_DELAY = 60
+    RECONNECT_MULTIPLIER = 2
+    RECONNECT_MAX_ATTEMPTS = None
+    # Received messages wait in a queue of RECEIVE_QUEUE_SIZE for the
+    # Receive thread. When it is full the network thread waits ('block')
+    # or the message is dropped ('drop').
+    RECEIVE_QUEUE_SIZE = 1000
+    RECEIVE_QUEUE_POLICY = 'block'
+    # None keeps input for the Controller in a single FIFO queue. A dict of
+    # lane weights (command, addnode, query, poll; {} for the defaults)
+    # serves it by priority lane instead, and anything waiting longer than
+    # INPUT_MAX_WAIT seconds goes first.
+    INPUT_LANE_WEIGHTS = None
+    INPUT_MAX_WAIT = 10
+    # Nodes per addnode message sent by addNodes
+    ADD_NODES_CHUNK = 50
+    # Seconds to wait for Polyglot to answer addNode, delNode, saveCustom
+    # and tracked driver sets before their futures fail with TimeoutError.
+    # With TRACK_DRIVER_SETS setDriver returns a future for each set sent.
+    REQUEST_TIMEOUT = 60
+    TRACK_DRIVER_SETS = False
 
     """
     Polyglot Interface Class
 
     :param envVar: The Name of the variable from ~/.polyglot/.env that has this NodeServer's profile number
+    :param transport: Transport for the MQTT traffic (see polytransport), a paho client by default
     """
     # pylint: disable=too-many-instance-attributes
     # pylint: disable=unused-argument
 
     __exists = False
 
-    def __init__(self, envVar=None):
+    def __init__(self, envVar=None, transport=None):
         if self.__exists:
             warnings.warn('Only one Interface is allowed.')
             return
+        from . import __description__, __version__
+        LOGGER.info('{} {} Starting...'.format(__description__, __version__))
         try:
             self.pg3init = json.loads(
                 base64.b64decode(os.environ.get('PG3INIT')))
         except:
             LOGGER.error('Failed to parse init. Exiting...',exc_info=True)
             sys.exit(1)
+        self.codec = getCodec(os.environ.get('PG3_JSON_CODEC', self.JSON_CODEC))
+        LOGGER.info('Using {} JSON codec'.format(self.codec.name))
         self.config = None
+        self._nodeIndex = {}
+        self._driverIndex = {}
+        self.configStats = {'received': 0, 'changed': 0, 'removed': 0}
+        self.requests = PendingRequests(self.REQUEST_TIMEOUT)
+        self._receiveQueue = queue.Queue(self.RECEIVE_QUEUE_SIZE)
+        self.receiveStats = {'received': 0, 'processed': 0, 'dropped': 0,
+                             'blocked': 0, 'maxDepth': 0}
         self.connected = False
         self.uuid = self.pg3init['uuid']
         self.profileNum = str(self.pg3init['profileNum'])
@@ -164,7 +263,11 @@ class Interface(object):
         self._threads = {}
         self._threads['socket'] = Thread(
             target=self._startMqtt, name='Interface')
-        self._mqttc = mqtt.Client(self.id, True)
+        # Started with the MQTT thread, before anything can be received
+        self._threads['receive'] = Thread(
+            target=self._receiveWorker, name='Receive')
+        self._threads['receive'].daemon = True
+        self._mqttc = transport if transport is not None else pahoTransport(self.id)
         self._mqttc.username_pw_set(self.id, self.pg3init['token'])
         self._mqttc.on_connect = self._connect
         self._mqttc.on_message = self._message
@@ -172,14 +275,28 @@ class Interface(object):
         self._mqttc.on_disconnect = self._disconnect
         self._mqttc.on_publish = self._publish
         self._mqttc.on_log = self._log
+        self.reconnectPolicy = ReconnectPolicy(
+            self.RECONNECT_INITIAL_DELAY, self.RECONNECT_MAX_DELAY,
+            self.RECONNECT_MULTIPLIER, self.RECONNECT_MAX_ATTEMPTS)
+        self.reconnectStats = {'disconnects': 0, 'attempts': 0, 'reconnects': 0,
+                               'lastReconnectTime': None}
+        self._disconnectedAt = None
+        self._connectFailures = 0
+        self._stopping = Event()
+        self._receivedCounters = {}
+        self._publishedCounters = {}
         self.useSecure = True
         self.custom = {}
         if self.pg3init['secure'] is 1:
+            import ssl
             self.sslContext = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
             self.sslContext.check_hostname = False
         self._mqttc.tls_set_context(self.sslContext)
         self.loop = None
-        self.inQueue = queue.Queue()
+        if self.INPUT_LANE_WEIGHTS is None:
+            self.inQueue = queue.Queue()
+        else:
+            self.inQueue = PriorityInputQueue(self.INPUT_LANE_WEIGHTS, self.INPUT_MAX_WAIT)
         # self.thread = Thread(target=self.start_loop)
         self.isyVersion = None
         self._server = self.pg3init['mqttHost'] or 'localhost'
@@ -191,14 +308,90 @@ class Interface(object):
         self.custom_params_docs_file_sent = False
         self.custom_params_pending_docs = ''
         self.currentLogLevel = ''
-        try:
-            self.network_interface = self.get_network_interface()
-            LOGGER.info('Connect: Network Interface: {}'.format(
-                self.network_interface))
-        except:
-            self.network_interface = False
-            LOGGER.error(
-                'Failed to determine Network Interface', exc_info=True)
+        self._sendLock = RLock()
+        self._batch = OrderedDict()
+        self._batchTimer = None
+        self._offlineState = OrderedDict()
+        self._offlineMessages = deque()
+        self.offlineStats = {'buffered': 0, 'dropped': 0, 'replayed': 0}
+        self._customLock = Lock()
+        self._customDirty = OrderedDict()
+        self._customHashes = {}
+        self._customSent = {}
+        self._customTimer = None
+        self._pollLock = Lock()
+        self._queuedPolls = set()
+        self.pollsCoalesced = {'shortPoll': 0, 'longPoll': 0}
+        self._registerMetrics()
+        self._networkInterface = None
+        if hasattr(main, '__file__'):
+            init_interface()
+
+    @property
+    def network_interface(self):
+        """ The default network interface, looked up on first use. """
+        if self._networkInterface is None:
+            try:
+                self._networkInterface = self.get_network_interface()
+                LOGGER.info('Connect: Network Interface: {}'.format(
+                    self._networkInterface))
+            except:
+                self._networkInterface = False
+                LOGGER.error(
+                    'Failed to determine Network Interface', exc_info=True)
+        return self._networkInterface
+
+    @network_interface.setter
+    def network_interface(self, value):
+        self._networkInterface = value
+
+    def _registerMetrics(self):
+        METRICS.gauge('polyinterface_connected', 'MQTT connection state',
+                      fn=lambda: 1 if self.connected else 0)
+        METRICS.gauge('polyinterface_input_queue_depth', 'Input messages waiting for the Controller',
+                      fn=self.inQueue.qsize)
+        if isinstance(self.inQueue, PriorityInputQueue):
+            for lane in self.inQueue.lanes:
+                METRICS.gauge('polyinterface_input_lane_depth', 'Input messages waiting per priority lane',
+                              fn=functools.partial(self.inQueue.laneSize, lane), lane=lane)
+        METRICS.gauge('polyinterface_receive_queue_depth', 'Received messages waiting to be decoded',
+                      fn=self._receiveQueue.qsize)
+        for key, help in (('dropped', 'Received messages dropped, receive queue full'),
+                          ('blocked', 'Times the network thread waited on a full receive queue')):
+            METRICS.counter('polyinterface_receive_{}_total'.format(key), help,
+                            fn=functools.partial(self.receiveStats.get, key))
+        for key, help in (('buffered', 'Messages buffered while MQTT was disconnected'),
+                          ('dropped', 'Buffered messages dropped, buffer full'),
+                          ('replayed', 'Buffered messages sent after reconnecting')):
+            METRICS.counter('polyinterface_offline_{}_total'.format(key), help,
+                            fn=functools.partial(self.offlineStats.get, key))
+        for key, help in (('disconnects', 'Unexpected MQTT disconnects'),
+                          ('attempts', 'MQTT connect and reconnect retries'),
+                          ('reconnects', 'Successful MQTT reconnects')):
+            METRICS.counter('polyinterface_mqtt_{}_total'.format(key), help,
+                            fn=functools.partial(self.reconnectStats.get, key))
+        METRICS.gauge('polyinterface_mqtt_last_reconnect_seconds', 'Time the last reconnect took',
+                      fn=lambda: self.reconnectStats['lastReconnectTime'] or 0)
+        for key in self.pollsCoalesced:
+            METRICS.counter('polyinterface_polls_coalesced_total', 'Polls dropped because one was already queued',
+                            fn=functools.partial(self.pollsCoalesced.get, key), poll=key)
+        METRICS.counter('polyinterface_log_records_dropped_total', 'Log records dropped by the log queue',
+                        fn=lambda: (LOG_HANDLER.queue_stats() or {}).get('dropped', 0))
+
+    def metrics(self):
+        """
+        Prometheus text format snapshot of the interface metrics. Use
+        polyinterface.METRICS.startFileExport() to write it to the log
+        directory periodically.
+        """
+        return METRICS.render()
+
+    def _countReceived(self, key):
+        counter = self._receivedCounters.get(key)
+        if counter is None:
+            counter = self._receivedCounters[key] = METRICS.counter(
+                'polyinterface_messages_received_total', 'Messages received from Polyglot', key=key)
+        counter.inc()
 
     def onConfig(self, callback):
         """
@@ -226,7 +419,11 @@ class Interface(object):
         if current_thread().name != "MQTT":
             current_thread().name = "MQTT"
         if rc == 0:
-            self.connected = True
+            self._connectFailures = 0
+            if self._disconnectedAt is not None:
+                self.reconnectStats['reconnects'] += 1
+                self.reconnectStats['lastReconnectTime'] = time.time() - self._disconnectedAt
+                self._disconnectedAt = None
             results = []
             LOGGER.info("MQTT Connected with result code " +
                         str(rc) + " (Success)")
@@ -243,6 +440,11 @@ class Interface(object):
                                 " failed. This is unusual. MID: " + str(mid) + " Result: " + str(result))
                     # If subscription fails, try to reconnect.
                     self._mqttc.reconnect()
+            # Sends keep being buffered until the replay is done, so nothing
+            # newer goes out ahead of a buffered value
+            with self._sendLock:
+                self.connected = True
+                self._replayOffline()
             self.send({'getAll': {}}, 'custom')
         else:
             LOGGER.error("MQTT Failed to connect. Result code: " + str(rc))
@@ -250,24 +452,72 @@ class Interface(object):
     def _message(self, mqttc, userdata, msg):
         """
         The callback for when a PUBLISH message is received from the server.
+        Runs on the network thread, so it only queues the raw payload for
+        the Receive thread, see _route.
 
         :param mqttc: The client instance for this callback
         :param userdata: The private userdata for the mqtt client. Not used in Polyglot
         :param flags: The flags set on the connection.
         :param msg: Dictionary of MQTT received message. Uses: msg.topic, msg.qos, msg.payload
         """
+        item = (time.time(), msg.topic, msg.payload)
+        stats = self.receiveStats
+        stats['received'] += 1
+        try:
+            self._receiveQueue.put_nowait(item)
+        except queue.Full:
+            if self.RECEIVE_QUEUE_POLICY == 'drop':
+                stats['dropped'] += 1
+                LOGGER.error('Receive queue full, dropped message on {}'.format(msg.topic))
+                return
+            stats['blocked'] += 1
+            self._receiveQueue.put(item)
+        depth = self._receiveQueue.qsize()
+        if depth > stats['maxDepth']:
+            stats['maxDepth'] = depth
+
+    def _receiveWorker(self):
+        waited = METRICS.histogram('polyinterface_receive_wait_seconds',
+                                   'Time received messages waited for the Receive thread')
+        while True:
+            received, topic, payload = self._receiveQueue.get()
+            waited.observe(time.time() - received)
+            try:
+                self._route(topic, payload)
+            finally:
+                self.receiveStats['processed'] += 1
+                self._receiveQueue.task_done()
+
+    def waitReceived(self, timeout=None):
+        """
+        Wait until every message received so far has been routed. Returns
+        False if timeout (seconds) expired first.
+        """
+        pending = self._receiveQueue
+        deadline = None if timeout is None else time.time() + timeout
+        with pending.all_tasks_done:
+            while pending.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                pending.all_tasks_done.wait(remaining)
+        return True
+
+    def _route(self, topic, payload):
+        """ Decode a received payload and route it, on the Receive thread. """
         try:
             inputCmds = ['query', 'command', 'addnode',
                          'status', 'shortPoll', 'longPoll', 'delete',
                          'setLogLevel']
-            parsed_msg = json.loads(msg.payload.decode('utf-8'))
+            parsed_msg = self.codec.loads(payload)
             if DEBUG:
                 LOGGER.debug('MQTT Received Message: {}: {}'.format(
-                    msg.topic, parsed_msg))
+                    topic, parsed_msg))
             for key in parsed_msg:
+                self._countReceived(key)
                 if DEBUG:
                     LOGGER.debug('MQTT Processing Message: {}: {}'.format(
-                        msg.topic, parsed_msg))
+                        topic, parsed_msg))
                 if key == 'config':
                     self.inConfig(parsed_msg[key])
                 elif key == 'stop':
@@ -284,19 +534,24 @@ class Interface(object):
                     if isinstance(parsed_msg[key], list):
                         for item in parsed_msg[key]:
                             if item.get('address') is not None:
+                                self._updateDriverIndex(item)
+                                self.requests.resolve('set', (item.get('address'), item.get('driver')), item)
                                 LOGGER.info('Successfully set {} :: {} to {} UOM {}'.format(
                                     item.get('address'), item.get('driver'), item.get('value'), item.get('uom')))
-                            elif item.get('success'):
-                                if item.get('success') is True:
-                                    for type in item:
-                                        if type != 'success':
-                                            LOGGER.info(
-                                                'Successfully set {}'.format(type))
-                                else:
-                                    for type in item:
-                                        if type != 'success':
-                                            LOGGER.error(
-                                                'Failed to set {} :: Error: {}'.format(type, ))
+                            elif 'success' in item:
+                                for type in item:
+                                    if type in ('success', 'error'):
+                                        continue
+                                    if item.get('success') is True:
+                                        self.requests.resolve('custom', type, item)
+                                        LOGGER.info(
+                                            'Successfully set {}'.format(type))
+                                    else:
+                                        # Not saved, send it again on the next save
+                                        self._customHashes.pop(type, None)
+                                        error = 'Failed to set {} :: Error: {}'.format(type, item.get('error'))
+                                        self.requests.reject('custom', type, RequestError(error, item))
+                                        LOGGER.error(error)
 
                     else:
                         LOGGER.error('set input was not a list')
@@ -306,14 +561,24 @@ class Interface(object):
                             LOGGER.debug(
                                 'Received {} from database'.format(custom.get('key')))
                             try:
-                                value = json.loads(custom.get('value'))
+                                value = self.codec.loads(custom.get('value'))
                                 self.custom[custom.get('key')] = value
                             except ValueError as e:
                                 self.custom[custom.get(
                                     'key')] = custom.get('value')
+                            self._customHashes[custom.get('key')] = self._customHash(
+                                self.custom[custom.get('key')])
                     if self.config is None:
                         self.send({'config': {}}, 'system')
+                elif key == 'removenode':
+                    results = parsed_msg[key]
+                    for item in results if isinstance(results, list) else [results]:
+                        self.requests.resolve('removenode', item.get('address'), item)
                 elif key in inputCmds:
+                    if key == 'addnode':
+                        results = parsed_msg[key]
+                        for item in results if isinstance(results, list) else [results]:
+                            self.requests.resolve('addnode', item.get('address'), item)
                     self.input(parsed_msg)
                 else:
                     LOGGER.error(
@@ -338,14 +603,11 @@ class Interface(object):
         """
         self.connected = False
         if rc != 0:
-            LOGGER.info(
-                "MQTT Unexpected disconnection. Trying reconnect. rc: {}".format(rc))
-            try:
-                self._mqttc.reconnect()
-            except Exception as ex:
-                template = "An exception of type {0} occured. Arguments:\n{1!r}"
-                message = template.format(type(ex).__name__, ex.args)
-                LOGGER.error("MQTT Connection error: " + message)
+            self.reconnectStats['disconnects'] += 1
+            if self._disconnectedAt is None:
+                self._disconnectedAt = time.time()
+            # loop_forever returns and _startMqtt reconnects
+            LOGGER.info("MQTT Unexpected disconnection. rc: {}".format(rc))
         else:
             LOGGER.info("MQTT Graceful disconnection.")
 
@@ -373,26 +635,38 @@ class Interface(object):
         The client start method. Starts the thread for the MQTT Client
         and publishes the connected message.
         """
+        import ssl
         LOGGER.info('Connecting to MQTT... {}:{}'.format(
             self._server, self._port))
-        done = False
-        while not done:
+        self._connectFailures = 0
+        while not self._stopping.is_set():
             try:
                 # self._mqttc.connect_async(str(self._server), int(self._port), 10)
                 self._mqttc.connect_async('{}'.format(
                     self._server), int(self._port), 10)
+                # Returns when the connection is lost, paho's own reconnect
+                # is off so every retry goes through the policy below.
                 self._mqttc.loop_forever()
-                done = True
+                if self._stopping.is_set():
+                    break
             except ssl.SSLError as e:
-                LOGGER.error("MQTT Connection SSLError: {}, Will retry in a few seconds.".format(
+                LOGGER.error("MQTT Connection SSLError: {}".format(
                     e), exc_info=True)
-                time.sleep(3)
             except Exception as ex:
                 template = "An exception of type {0} occurred. Arguments:\n{1!r}"
                 message = template.format(type(ex).__name__, ex.args)
                 LOGGER.error("MQTT Connection error: {}".format(
                     message), exc_info=True)
-                done = True
+            if self._stopping.is_set():
+                break
+            self._connectFailures += 1
+            if not self.reconnectPolicy.shouldRetry(self._connectFailures):
+                LOGGER.error("MQTT Giving up after {} connect attempts.".format(self._connectFailures))
+                break
+            delay = self.reconnectPolicy.delay(self._connectFailures - 1)
+            LOGGER.info("MQTT Retrying connection in {:.1f}s.".format(delay))
+            self._stopping.wait(delay)
+            self.reconnectStats['attempts'] += 1
         LOGGER.debug("MQTT: Done")
 
     def stop(self):
@@ -405,6 +679,9 @@ class Interface(object):
         # self.loop.stop()
         # self._longPoll.cancel()
         # self._shortPoll.cancel()
+        self._stopping.set()
+        self.flushCustom()
+        self.flush()
         if self.connected:
             LOGGER.info('Disconnecting from MQTT... {}:{}'.format(
                 self._server, self._port))
@@ -422,6 +699,9 @@ class Interface(object):
         """
         Formatted Message to send to Polyglot. Connection messages are sent automatically from this module
         so this method is used to send commands to/from Polyglot and formats it for consumption
+
+        'set' messages for the types in SEND_BATCH_TYPES are held and
+        coalesced when SEND_BATCH_WINDOW is enabled, see flush().
         """
         if not isinstance(message, dict) and self.connected:
             warnings.warn('payload not a dictionary')
@@ -432,39 +712,249 @@ class Interface(object):
             if not type in validTypes:
                 warnings.warn('send: type not valid')
                 return False
-            topic = 'udi/pg3/ns/{}/{}'.format(type, self.id)
-            self._mqttc.publish(topic, json.dumps(message), retain=False)
+            with self._sendLock:
+                if self._isBatchable(message, type):
+                    self._addToBatch(message['set'], type)
+                else:
+                    # Anything not batched goes out after what is pending
+                    # so ordering is kept across message types.
+                    self.flush()
+                    self._publishMessage(message, type)
         except TypeError as err:
             LOGGER.error('MQTT Send Error: {}'.format(err), exc_info=True)
 
+    def flush(self):
+        """
+        Publish all pending batched 'set' items now. Each message type is
+        sent as a single {'set': [...]} message, in the order the types
+        were first used.
+        """
+        with self._sendLock:
+            if self._batchTimer is not None:
+                self._batchTimer.cancel()
+                self._batchTimer = None
+            if not self._batch:
+                return
+            pending = self._batch
+            self._batch = OrderedDict()
+            for type, items in pending.items():
+                try:
+                    self._publishMessage({'set': list(items.values())}, type)
+                except TypeError as err:
+                    LOGGER.error('MQTT Send Error: {}'.format(err), exc_info=True)
+
+    def _publishMessage(self, message, type):
+        if not self.connected:
+            self._bufferOffline(message, type)
+            return
+        topic = 'udi/pg3/ns/{}/{}'.format(type, self.id)
+        result = self._mqttc.publish(topic, self.codec.dumps(message), retain=False)
+        if getattr(result, 'rc', None) == MQTT_ERR_NO_CONN:
+            self._bufferOffline(message, type)
+            return
+        counter = self._publishedCounters.get(type)
+        if counter is None:
+            counter = self._publishedCounters[type] = METRICS.counter(
+                'polyinterface_messages_published_total', 'Messages published to Polyglot', type=type)
+        counter.inc()
+
+    def _bufferOffline(self, message, type):
+        """
+        Keep a message sent while disconnected. Driver updates only keep the
+        latest value per address and driver, anything else is kept in order.
+        """
+        items = message.get('set') if type == 'status' and len(message) == 1 else None
+        if isinstance(items, list) and all(
+                'address' in item and 'driver' in item for item in items):
+            for item in items:
+                key = (type, item['address'], item['driver'])
+                self._offlineState.pop(key, None)
+                self._offlineState[key] = item
+                self.offlineStats['buffered'] += 1
+            while len(self._offlineState) > self.OFFLINE_STATE_SIZE:
+                self._offlineState.popitem(last=False)
+                self.offlineStats['dropped'] += 1
+        else:
+            self._offlineMessages.append((message, type))
+            self.offlineStats['buffered'] += 1
+            while len(self._offlineMessages) > self.OFFLINE_BUFFER_SIZE:
+                self._offlineMessages.popleft()
+                self.offlineStats['dropped'] += 1
+
+    def _replayOffline(self):
+        """ Send what was buffered while disconnected, called once connected. """
+        with self._sendLock:
+            if not self._offlineMessages and not self._offlineState:
+                return
+            LOGGER.info('Sending {} messages and {} driver values buffered while disconnected'.format(
+                len(self._offlineMessages), len(self._offlineState)))
+            messages = self._offlineMessages
+            state = self._offlineState
+            self._offlineMessages = deque()
+            self._offlineState = OrderedDict()
+            for message, type in messages:
+                self._publishMessage(message, type)
+                self.offlineStats['replayed'] += 1
+            chunks = OrderedDict()
+            for (type, _, _), item in state.items():
+                chunk = chunks.setdefault(type, [])
+                chunk.append(item)
+                if len(chunk) >= self.OFFLINE_REPLAY_CHUNK:
+                    self._publishMessage({'set': chunk}, type)
+                    chunks[type] = []
+            for type, chunk in chunks.items():
+                if chunk:
+                    self._publishMessage({'set': chunk}, type)
+            self.offlineStats['replayed'] += len(state)
+
+    def offlineBufferStats(self):
+        """ Counters and current size of the disconnected buffer. """
+        with self._sendLock:
+            stats = dict(self.offlineStats)
+            stats['messages'] = len(self._offlineMessages)
+            stats['drivers'] = len(self._offlineState)
+        return stats
+
+    def _isBatchable(self, message, type):
+        return (self.SEND_BATCH_WINDOW > 0 and
+                type in self.SEND_BATCH_TYPES and
+                len(message) == 1 and
+                isinstance(message.get('set'), list))
+
+    def _addToBatch(self, items, type):
+        """
+        Queue 'set' items for the next flush. A newer item for the same
+        address/driver (or custom key) replaces the pending one and moves
+        to the end, so the last value wins and per node order is kept.
+        """
+        batch = self._batch.get(type)
+        if batch is None:
+            batch = self._batch[type] = OrderedDict()
+        for item in items:
+            key = (item.get('address'), item.get('driver'), item.get('key'))
+            if key == (None, None, None):
+                key = id(item)
+            batch.pop(key, None)
+            batch[key] = item
+        if sum(len(b) for b in self._batch.values()) >= self.SEND_BATCH_SIZE:
+            self.flush()
+        elif self._batchTimer is None:
+            self._batchTimer = Timer(self.SEND_BATCH_WINDOW, self.flush)
+            self._batchTimer.daemon = True
+            self._batchTimer.start()
+
     def addNode(self, node):
         """
         Add a node to the NodeServer
 
         :param node: Dictionary of node settings. Keys: address, name, node_def_id, primary, and drivers are required.
+        :returns: Future resolved with Polyglot's addnode result.
         """
         LOGGER.info('Adding node {}({})'.format(node.name, node.address))
         message = {
-            'addnode': [{
-                'address': node.address,
-                'name': node.name,
-                'nodeDefId': node.id,
-                'primaryNode': node.primary,
-                'drivers': node.drivers,
-                'hint': node.hint
-            }]
+            'addnode': [self._addNodeEntry(node)]
         }
+        future = self.requests.track('addnode', node.address)
         self.send(message, 'command')
+        return future
+
+    def addNodes(self, nodes, chunk=None):
+        """
+        Add many nodes to the NodeServer, ADD_NODES_CHUNK (or chunk) nodes
+        per addnode message.
+
+        :param nodes: Iterable of nodes.
+        :returns: List of futures like addNode.
+        """
+        chunk = chunk or self.ADD_NODES_CHUNK
+        entries = [self._addNodeEntry(node) for node in nodes]
+        added = [self.requests.track('addnode', entry['address']) for entry in entries]
+        for start in range(0, len(entries), chunk):
+            batch = entries[start:start + chunk]
+            LOGGER.info('Adding {} nodes ({} ... {})'.format(
+                len(batch), batch[0]['address'], batch[-1]['address']))
+            self.send({'addnode': batch}, 'command')
+        return added
+
+    def _addNodeEntry(self, node):
+        return {
+            'address': node.address,
+            'name': node.name,
+            'nodeDefId': node.id,
+            'primaryNode': node.primary,
+            'drivers': [dict(d) for d in node.drivers],
+            'hint': node.hint
+        }
 
     def saveCustom(self, key):
         """
         Send custom dictionary to Polyglot to save and be retrieved on startup.
+        With CUSTOM_SAVE_DELAY set the key is sent by flushCustom() once the
+        delay has passed. Nothing is sent if the value didn't change since it
+        was last sent or received.
 
         :param key: Dictionary of key value pairs to store in Polyglot database.
+        :returns: Future resolved when Polyglot confirms the save, right
+            away with None if there was nothing to send.
+        """
+        future = self.requests.track('custom', key)
+        if self.CUSTOM_SAVE_DELAY > 0:
+            with self._customLock:
+                self._customDirty[key] = True
+                self._scheduleCustomFlush()
+        else:
+            self._sendCustom(key)
+        return future
+
+    def flushCustom(self):
         """
+        Send all custom keys waiting on CUSTOM_SAVE_DELAY now.
+        """
+        with self._customLock:
+            if self._customTimer is not None:
+                self._customTimer.cancel()
+                self._customTimer = None
+            keys = list(self._customDirty)
+            self._customDirty.clear()
+        for key in keys:
+            try:
+                self._sendCustom(key)
+            except Exception as err:
+                LOGGER.error('Failed to send custom {}: {}'.format(key, err), exc_info=True)
+                with self._customLock:
+                    # Try it again on the next flush
+                    self._customDirty[key] = True
+                    if self.CUSTOM_SAVE_DELAY > 0:
+                        self._scheduleCustomFlush()
+
+    def _scheduleCustomFlush(self):
+        """ Start the CUSTOM_SAVE_DELAY timer, called with _customLock held. """
+        if self._customTimer is None:
+            self._customTimer = Timer(
+                self.CUSTOM_SAVE_DELAY, self.flushCustom)
+            self._customTimer.daemon = True
+            self._customTimer.start()
+
+    def _customHash(self, value):
+        try:
+            data = json.dumps(value, sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def _sendCustom(self, key):
+        value = self.custom[key]
+        digest = self._customHash(value)
+        if digest is not None and digest == self._customHashes.get(key):
+            LOGGER.debug('Custom {} unchanged, not sending.'.format(key))
+            # saves already sent still wait for Polyglot's answer
+            self.requests.resolve('custom', key, None, self._customSent.get(key))
+            return
         LOGGER.info('Sending custom {} to Polyglot.'.format(key))
-        message = {'set': [{'key': key, 'value': self.custom[key]}]}
+        message = {'set': [{'key': key, 'value': value}]}
+        self._customSent[key] = time.time()
         self.send(message, 'custom')
+        self._customHashes[key] = digest
 
     # def saveCustomParams(self, data):
     #     """
@@ -506,6 +996,7 @@ class Interface(object):
         Delete a node from the NodeServer
 
         :param node: Dictionary of node settings. Keys: address, name, node_def_id, primary, and drivers are required.
+        :returns: Future resolved with Polyglot's removenode result.
         """
         LOGGER.info('Removing node {}'.format(address))
         message = {
@@ -513,28 +1004,88 @@ class Interface(object):
                 'address': address
             }
         }
+        future = self.requests.track('removenode', address)
         self.send(message, 'command')
+        return future
 
     def getNode(self, address):
         """
         Get Node by Address of existing nodes.
         """
-        try:
-            for node in self.config['nodes']:
-                if node['address'] == address:
-                    return node
-            return False
-        except KeyError:
-            LOGGER.error(
-                'Usually means we have not received the config yet.', exc_info=True)
+        if self.config is None:
+            LOGGER.error('getNode: Usually means we have not received the config yet.')
             return False
+        return self._nodeIndex.get(address, False)
+
+    def getDriver(self, address, driver):
+        """
+        Get the value of a driver of an existing node as known by Polyglot.
+        """
+        entry = self._driverIndex.get((address, driver))
+        if entry is None:
+            return None
+        return entry['value']
+
+    def _indexConfig(self, config):
+        """
+        Update the address -> node and (address, driver) -> driver indexes
+        used by getNode and getDriver from a new config. Node entries equal
+        to the ones in the previous config are replaced by the previous
+        objects, so only changed nodes are re-indexed and Controller can
+        skip unchanged nodes by identity. Returns (changed, removed)
+        addresses.
+        """
+        nodeIndex = self._nodeIndex
+        driverIndex = self._driverIndex
+        nodes = config.get('nodes') or []
+        changed = []
+        seen = set()
+        for i, node in enumerate(nodes):
+            address = node['address']
+            seen.add(address)
+            previous = nodeIndex.get(address)
+            if previous is not None and previous is not node and previous == node:
+                nodes[i] = previous
+                continue
+            if previous is node:
+                continue
+            if previous is not None:
+                self._unindexDrivers(address, previous)
+            nodeIndex[address] = node
+            for driver in node.get('drivers') or []:
+                driverIndex.setdefault((address, driver['driver']), driver)
+            changed.append(address)
+        removed = [address for address in nodeIndex if address not in seen]
+        for address in removed:
+            self._unindexDrivers(address, nodeIndex.pop(address))
+        return changed, removed
+
+    def _unindexDrivers(self, address, node):
+        for driver in node.get('drivers') or []:
+            key = (address, driver['driver'])
+            if self._driverIndex.get(key) is driver:
+                del self._driverIndex[key]
+
+    def _updateDriverIndex(self, item):
+        """ Keep the driver index current with a successful set from Polyglot. """
+        entry = self._driverIndex.get((item.get('address'), item.get('driver')))
+        if entry is not None:
+            entry['value'] = item.get('value')
+            if item.get('uom') is not None:
+                entry['uom'] = item.get('uom')
 
     def inConfig(self, config):
         """
         Save incoming config received from Polyglot to Interface.config and then do any functions
         that are waiting on the config to be received.
         """
+        changed, removed = self._indexConfig(config)
         self.config = config
+        self.configStats['received'] += 1
+        self.configStats['changed'] += len(changed)
+        self.configStats['removed'] += len(removed)
+        LOGGER.debug('Config received: {} nodes changed, {} removed'.format(
+            len(changed), len(removed)))
         # self.isyVersion = config['isyVersion']
 
         """ is log level in here? """
@@ -551,7 +1102,29 @@ class Interface(object):
             LOGGER.error('KeyError in gotConfig: {}'.format(e), exc_info=True)
 
     def input(self, command):
-        self.inQueue.put(command)
+        if not self._coalescePoll(command):
+            self.inQueue.put(command)
+
+    def _coalescePoll(self, command):
+        """
+        Only one of each poll waits to be handled, True for polls that
+        arrive while one is pending and should be dropped.
+        """
+        if len(command) == 1:
+            for key in ('shortPoll', 'longPoll'):
+                if key in command:
+                    with self._pollLock:
+                        if key in self._queuedPolls:
+                            self.pollsCoalesced[key] += 1
+                            LOGGER.debug('{} already queued, skipping'.format(key))
+                            return True
+                        self._queuedPolls.add(key)
+        return False
+
+    def _pollStarted(self, key):
+        """ Allow the next poll of this type to be queued. """
+        with self._pollLock:
+            self._queuedPolls.discard(key)
 
     def supports_feature(self, feature):
         return True
@@ -569,7 +1142,7 @@ class Interface(object):
     def get_md_file_data(self, fileName):
         data = ''
         if os.path.isfile(fileName):
-            data = markdown2.markdown_path(fileName)
+            data = FILE_CACHE.get(fileName, _renderMarkdown)
 
         return data
 
@@ -638,13 +1211,11 @@ class Interface(object):
         serverdata = {'version': 'unknown'}
         # Read the SERVER info from the json.
         try:
-            with open(Interface.SERVER_JSON_FILE_NAME) as data:
-                serverdata = json.load(data)
+            serverdata = deepcopy(FILE_CACHE.get(Interface.SERVER_JSON_FILE_NAME, _loadJson))
         except Exception as err:
             LOGGER.error('get_server_data: failed to read file {0}: {1}'.format(
                 Interface.SERVER_JSON_FILE_NAME, err), exc_info=True)
             return serverdata
-        data.close()
         # Get the version info
         try:
             version = serverdata['credits'][0]['version']
@@ -717,8 +1288,18 @@ class Node(object):
             self.address = address
             self.name = name
             self.polyConfig = None
-            self.drivers = deepcopy(self.drivers)
-            self._drivers = deepcopy(self.drivers)
+            if self.compactDrivers:
+                self._driverStore = DriverStore(DriverSchema.forClass(type(self)))
+                self.drivers = self._driverStore.view()
+                self._drivers = self._driverStore.view(reported=True)
+            else:
+                drivers = self._copyDrivers()
+                self._drivers = self._copyDrivers()
+                self.drivers = drivers
+            self._driverIndex = {}
+            self._indexDrivers()
+            self._reportTimes = {}
+            self._reportTimers = {}
             self.isPrimary = None
             self.config = None
             self.timeAdded = None
@@ -741,37 +1322,155 @@ class Node(object):
             return deepcopy(drivers)
         """
 
+    def _copyDrivers(self):
+        """
+        Copy of the drivers list for this instance. Class-level lists are
+        stamped from the per class DriverSchema instead of deep copied.
+        """
+        if 'drivers' not in self.__dict__:
+            try:
+                return DriverSchema.forClass(type(self)).stamp()
+            except (KeyError, TypeError, AttributeError):
+                pass
+        return deepcopy(self.drivers)
+
+    def _indexDrivers(self):
+        """ (Re)build the driver code -> position index for drivers and _drivers. """
+        self._findDriver('drivers', self.drivers, None)
+        self._findDriver('_drivers', self._drivers, None)
+
+    def _findDriver(self, slot, drivers, code):
+        """
+        Return the entry for driver code in the drivers list using a cached
+        code -> position index. The index for each slot is rebuilt when the
+        list is replaced or was modified so a lookup no longer matches.
+        """
+        index = self.__dict__.get('_driverIndex')
+        if index is None:
+            index = self._driverIndex = {}
+        cached = index.get(slot)
+        if cached is not None and cached[0] is drivers:
+            pos = cached[1].get(code)
+            if (pos is not None and pos < len(drivers) and
+                    drivers[pos]['driver'] == code):
+                return drivers[pos]
+        positions = {}
+        for pos, d in enumerate(drivers or []):
+            positions.setdefault(d['driver'], pos)
+        index[slot] = (drivers, positions)
+        pos = positions.get(code)
+        return None if pos is None else drivers[pos]
+
     def setDriver(self, driver, value, report=True, force=False, uom=None):
-        for d in self.drivers:
-            if d['driver'] == driver:
-                d['value'] = value
-                if uom is not None:
-                    d['uom'] = uom
-                if report:
-                    self.reportDriver(d, report, force)
-                break
+        store = self._driverStore
+        if store is not None:
+            pos = store.schema.index.get(driver)
+            if pos is None:
+                return
+            store.values[pos] = value
+            if uom is not None:
+                store.uoms[pos] = uom
+            if report:
+                return self.reportDriver(self.drivers[pos], report, force)
+            return
+        d = self._findDriver('drivers', self.drivers, driver)
+        if d is not None:
+            d['value'] = value
+            if uom is not None:
+                d['uom'] = uom
+            if report:
+                return self.reportDriver(d, report, force)
 
     def reportDriver(self, driver, report, force):
-        for d in self._drivers:
-            if (d['driver'] == driver['driver'] and
-                (str(d['value']) != str(driver['value']) or
-                    d['uom'] != driver['uom'] or
-                    force)):
-                LOGGER.info('Updating Driver {} - {}: {}, uom: {}'.format(self.address,
-                                                                          driver['driver'], driver['value'], driver['uom']))
-                d['value'] = deepcopy(driver['value'])
-                if d['uom'] != driver['uom']:
-                    d['uom'] = deepcopy(driver['uom'])
-                message = {
-                    'set': [{
-                        'address': self.address,
-                        'driver': driver['driver'],
-                        'value': str(driver['value']),
-                        'uom': driver['uom']
-                    }]
-                }
-                self.controller.poly.send(message, 'status')
-                break
+        store = self._driverStore
+        code = driver['driver']
+        if store is not None:
+            pos = store.schema.index.get(code)
+            if pos is None:
+                return
+            reportedValue = store.reportedValues[pos]
+            reportedUom = store.reportedUoms[pos]
+        else:
+            d = self._findDriver('_drivers', self._drivers, code)
+            if d is None:
+                return
+            reportedValue = d['value']
+            reportedUom = d['uom']
+        policy = self.reportPolicies.get(code) if self.reportPolicies else None
+        if not force:
+            changed = (reportedUom != driver['uom'] or
+                       driverValueChanged(reportedValue, driver['value']))
+            if policy is not None:
+                changed = self._checkReportPolicy(code, policy, driver, reportedValue,
+                                                  reportedUom, changed)
+            if not changed:
+                return
+        if policy is not None:
+            self._reportTimes[code] = time.time()
+        if store is not None:
+            store.reportedValues[pos] = copyValue(driver['value'])
+            store.reportedUoms[pos] = driver['uom']
+        else:
+            d['value'] = copyValue(driver['value'])
+            if d['uom'] != driver['uom']:
+                d['uom'] = deepcopy(driver['uom'])
+        LOGGER.info('Updating Driver {} - {}: {}, uom: {}'.format(self.address,
+                                                                  driver['driver'], driver['value'], driver['uom']))
+        message = {
+            'set': [{
+                'address': self.address,
+                'driver': driver['driver'],
+                'value': str(driver['value']),
+                'uom': driver['uom']
+            }]
+        }
+        poly = self.controller.poly
+        future = None
+        if poly.TRACK_DRIVER_SETS:
+            future = poly.requests.track('set', (self.address, driver['driver']))
+        poly.send(message, 'status')
+        return future
+
+    def _checkReportPolicy(self, code, policy, driver, reportedValue, reportedUom, changed):
+        """
+        Apply the reportPolicies entry for a driver: heartbeat after
+        maxInterval, ignore changes within the deadband and hold back
+        changes for minInterval after the last report, reporting the latest
+        value once it has passed.
+        """
+        now = time.time()
+        last = self._reportTimes.get(code)
+        elapsed = None if last is None else now - last
+        maxInterval = policy.get('maxInterval')
+        if maxInterval and elapsed is not None and elapsed >= maxInterval:
+            return True
+        if not changed:
+            return False
+        if (reportedUom == driver['uom'] and
+                withinDeadband(reportedValue, driver['value'],
+                               policy.get('deadband'), policy.get('deadbandPercent'))):
+            return False
+        minInterval = policy.get('minInterval')
+        if minInterval and elapsed is not None and elapsed < minInterval:
+            if self._reportTimers.get(code) is None:
+                timer = Timer(minInterval - elapsed, self._reportHeld, (code,))
+                timer.daemon = True
+                self._reportTimers[code] = timer
+                timer.start()
+            return False
+        return True
+
+    def _reportHeld(self, code):
+        """ Report a value held back by minInterval. """
+        self._reportTimers.pop(code, None)
+        store = self._driverStore
+        if store is not None:
+            pos = store.schema.index.get(code)
+            driver = None if pos is None else self.drivers[pos]
+        else:
+            driver = self._findDriver('drivers', self.drivers, code)
+        if driver is not None:
+            self.reportDriver(driver, True, False)
 
     def reportCmd(self, command, value=None, uom=None):
         message = {
@@ -801,7 +1500,11 @@ class Node(object):
         self.controller.poly.send(message, 'status')
 
     def updateDrivers(self, drivers):
+        if self._driverStore is not None:
+            self._driverStore.update(drivers)
+            return
         self._drivers = deepcopy(drivers)
+        self._findDriver('_drivers', self._drivers, None)
 
     def query(self):
         self.reportDrivers()
@@ -812,21 +1515,16 @@ class Node(object):
     def runCmd(self, command):
         if command['command'] in self.commands:
             fun = self.commands[command['command']]
-            fun(self, command)
+            return fun(self, command)
 
     def start(self):
         pass
 
     def getDriver(self, dv):
-        for index, node in enumerate(self.controller.poly.config['nodes']):
-            LOGGER.debug('{} :: {} :: getting dv {}'.format(index, node, dv))
-            if node['address'] == self.address:
-                for idx, driver in enumerate(node['drivers']):
-                    LOGGER.debug('{} :: {} - {} :: getting dv {}'.format(idx,
-                                                                         driver['driver'], driver['value'], dv))
-                    if driver['driver'] == dv:
-                        return driver['value']
-        return None
+        """
+        Get the value of driver dv as last received from Polyglot.
+        """
+        return self.controller.poly.getDriver(self.address, dv)
 
     def toJSON(self):
         LOGGER.debug(json.dumps(self.__dict__))
@@ -839,6 +1537,17 @@ class Node(object):
     drivers = []
     sends = {}
     hint = [0, 0, 0, 0]
+    # Set to True in a subclass to keep driver state in a compact
+    # DriverStore instead of two deep copied lists of dictionaries.
+    compactDrivers = False
+    _driverStore = None
+    # Per driver reporting policies, e.g.
+    #   {'CLITEMP': {'deadband': 0.5, 'minInterval': 10, 'maxInterval': 600}}
+    # deadband/deadbandPercent: changes up to this much (absolute or percent
+    # of the reported value) are not reported. minInterval: seconds between
+    # reports, the latest value is reported when it passes. maxInterval:
+    # re-report on setDriver if nothing was reported for this long.
+    reportPolicies = {}
 
 
 class Controller(Node):
@@ -846,6 +1555,11 @@ class Controller(Node):
     Controller Class for controller management. Superclass of Node
     """
     __exists = False
+    # Run input handlers on a pool of DISPATCH_WORKERS threads, serialized
+    # per node address. 0 keeps everything on the single Controller thread.
+    # Handlers running longer than DISPATCH_TIMEOUT seconds are reported.
+    DISPATCH_WORKERS = 0
+    DISPATCH_TIMEOUT = None
 
     def __init__(self, poly, name='Controller'):
         if self.__exists:
@@ -860,7 +1574,9 @@ class Controller(Node):
             self.name = name
             self.address = 'controller'
             self.primary = self.address
-            self._drivers = deepcopy(self.drivers)
+            self._drivers = self._copyDrivers()
+            self._reportTimes = {}
+            self._reportTimers = {}
             self._nodes = {}
             self.config = None
             self.nodes = {self.address: self}
@@ -874,7 +1590,18 @@ class Controller(Node):
             self.enabled = None
             self.added = None
             self.started = False
-            self.nodesAdding = []
+            # address -> Future resolved with the addnode result
+            self.nodesAdding = {}
+            self._addingLock = Lock()
+            self.poller = None
+            self._localPolls = False
+            self._pollStats = {'shortPoll': PollStats(), 'longPoll': PollStats()}
+            self._dispatcher = None
+            if self.DISPATCH_WORKERS > 0:
+                self._dispatcher = KeyedDispatcher(
+                    self.DISPATCH_WORKERS, self.DISPATCH_TIMEOUT)
+            self._handlerTimers = {}
+            self._registerMetrics()
             # self._threads = []
             self._startThreads()
         except (KeyError) as err:
@@ -882,16 +1609,25 @@ class Controller(Node):
 
     def _gotConfig(self, config):
         self.polyConfig = config
+        seen = set()
         for node in config['nodes']:
-            self._nodes[node['address']] = node
-            if node['address'] in self.nodes:
-                n = self.nodes[node['address']]
+            address = node['address']
+            seen.add(address)
+            # Interface reuses the previous entry for unchanged nodes
+            if self._nodes.get(address) is node and (
+                    address not in self.nodes or self.nodes[address].config is node):
+                continue
+            self._nodes[address] = node
+            if address in self.nodes:
+                n = self.nodes[address]
                 n.updateDrivers(node['drivers'])
                 n.config = node
                 n.isPrimary = node['isPrimary']
                 n.timeAdded = node['timeAdded']
                 n.enabled = node['enabled']
                 n.added = node['enabled']
+        for address in [a for a in self._nodes if a not in seen]:
+            del self._nodes[address]
         customtypes = ['customparams', 'customdata', 'customparamsdoc',
                        'customtypeddata', 'customtypedparams']
         for type in customtypes:
@@ -913,15 +1649,67 @@ class Controller(Node):
 
     def _parseInput(self):
         while True:
+            if self._dispatcher is not None:
+                # Leave the backlog in inQueue's priority lanes until a
+                # worker can take it
+                self._dispatcher.waitIdle()
             input = self.poly.inQueue.get()
             for key in input:
                 if isinstance(input[key], list):
                     for item in input[key]:
-                        self._handleInput(key, item)
+                        self._dispatchInput(key, item)
                 else:
-                    self._handleInput(key, input[key])
+                    self._dispatchInput(key, input[key])
             self.poly.inQueue.task_done()
 
+    def _dispatchInput(self, key, item):
+        """
+        Handle the input here or, when the dispatch pool is enabled, queue it
+        behind earlier input for the same node address.
+        """
+        if self._dispatcher is None:
+            self._timedInput(key, item)
+        else:
+            address = item.get('address') if isinstance(item, dict) else None
+            self._dispatcher.submit(address or key, self._timedInput, key, item)
+
+    def _timedInput(self, key, item):
+        started = time.time()
+        try:
+            self._handleInput(key, item)
+        finally:
+            self._handlerTimer(key).observe(time.time() - started)
+
+    def _handlerTimer(self, key):
+        timer = self._handlerTimers.get(key)
+        if timer is None:
+            timer = self._handlerTimers[key] = METRICS.histogram(
+                'polyinterface_handler_duration_seconds', 'Time spent handling input from Polyglot', handler=key)
+        return timer
+
+    def _registerMetrics(self):
+        METRICS.gauge('polyinterface_nodes', 'Nodes in the Controller', fn=lambda: len(self.nodes))
+        METRICS.gauge('polyinterface_nodes_adding', 'Nodes waiting on the addnode result',
+                      fn=lambda: len(self.nodesAdding))
+        if self._dispatcher is not None:
+            for key in ('queued', 'active', 'keys'):
+                METRICS.gauge('polyinterface_dispatch_{}'.format(key), 'Dispatch pool {}'.format(key),
+                              fn=functools.partial(self._dispatchStat, key))
+            for key in ('submitted', 'completed', 'failed', 'timeouts'):
+                METRICS.counter('polyinterface_dispatch_{}_total'.format(key), 'Dispatch pool jobs {}'.format(key),
+                                fn=functools.partial(self._dispatchStat, key))
+
+    def _dispatchStat(self, key):
+        return self._dispatcher.stats()[key]
+
+    def dispatchStats(self):
+        """
+        Queue depth and counters of the dispatch pool, None when disabled.
+        """
+        if self._dispatcher is None:
+            return None
+        return self._dispatcher.stats()
+
     def _handleInput(self, key, item):
         if key == 'command':
             if item['address'] in self.nodes:
@@ -934,13 +1722,20 @@ class Controller(Node):
                 LOGGER.error('_parseInput: received command {} for a node that is not in memory: {}'.format(
                     item['cmd'], item['address']))
         elif key == 'addnode':
-            self._handleResult(item)
+            try:
+                self._handleResult(item)
+            finally:
+                self._addDone(item)
         elif key == 'delete':
             self._delete()
         elif key == 'shortPoll':
-            self.shortPoll()
+            self.poly._pollStarted(key)
+            if not self._localPolls:
+                self._poll(key)
         elif key == 'longPoll':
-            self.longPoll()
+            self.poly._pollStarted(key)
+            if not self._localPolls:
+                self._poll(key)
         elif key == 'query':
             if item['address'] in self.nodes:
                 self.nodes[item['address']].query()
@@ -957,15 +1752,20 @@ class Controller(Node):
         try:
             if result.get('address'):
                 if not result.get('address') == self.address:
-                    self.nodes.get(result.get('address')).start()
+                    return self.nodes.get(result.get('address')).start()
                 # self.nodes[result['addnode']['address']].reportDrivers()
-                if result.get('address') in self.nodesAdding:
-                    self.nodesAdding.remove(result.get('address'))
             else:
                 del self.nodes[result.get('address')]
         except (KeyError, ValueError) as err:
             LOGGER.error('handleResult: {}'.format(err), exc_info=True)
 
+    def _addDone(self, result):
+        """ The node's start() is done, complete its nodesAdding future. """
+        with self._addingLock:
+            future = self.nodesAdding.pop(result.get('address'), None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
     def _delete(self):
         """
         Intermediate message that stops MQTT before sending to overrideable method for delete.
@@ -1000,30 +1800,92 @@ class Controller(Node):
     """
 
     def addNode(self, node, update=False):
-        if node.address in self._nodes:
-            node._drivers = self._nodes[node.address]['drivers']
-            for driver in node.drivers:
-                for existing in self._nodes[node.address]['drivers']:
-                    if driver['driver'] == existing['driver']:
-                        driver['value'] = existing['value']
-                        # JIMBO SAYS NO
-                        # driver['uom'] = existing['uom']
-        self.nodes[node.address] = node
-        # if node.address not in self._nodes or update:
-        self.nodesAdding.append(node.address)
-        self.poly.addNode(node)
+        self._prepareNode(node)
+        added = self._trackAdd(node.address)
+        self._watchAck(node.address, added, self.poly.addNode(node))
         # else:
         #    self.nodes[node.address].start()
         return node
 
+    def addNodes(self, nodes, chunk=None):
+        """
+        Add many nodes with chunked addnode messages. Returns a dict of
+        address to a concurrent.futures.Future resolved with the addnode
+        result once the node is started, see waitForNodes, or failed like
+        the interface's acknowledgement. Use asyncio.wrap_future to await
+        them on an event loop.
+        """
+        nodes = list(nodes)
+        added = OrderedDict()
+        for node in nodes:
+            self._prepareNode(node)
+            added[node.address] = self._trackAdd(node.address)
+        acks = self.poly.addNodes(nodes, chunk)
+        for node, ack in zip(nodes, acks):
+            self._watchAck(node.address, added[node.address], ack)
+        return added
+
+    def waitForNodes(self, addresses=None, timeout=None):
+        """
+        Wait until the given (default all) pending node adds complete.
+        Returns the addresses still pending when timeout expires.
+        """
+        with self._addingLock:
+            if addresses is None:
+                pending = dict(self.nodesAdding)
+            else:
+                pending = dict((a, self.nodesAdding[a]) for a in addresses
+                               if a in self.nodesAdding)
+        futures.wait(pending.values(), timeout)
+        return set(a for a, f in pending.items() if not f.done())
+
+    def _trackAdd(self, address):
+        with self._addingLock:
+            future = self.nodesAdding.get(address)
+            if future is None:
+                future = self.nodesAdding[address] = futures.Future()
+            return future
+
+    def _watchAck(self, address, added, ack):
+        """
+        Fail the nodesAdding future added when ack, the interface's future
+        for the addnode response, fails (no response in time). A successful
+        response completes it once the node is started, see _addDone.
+        """
+        def acked(ack):
+            if ack.cancelled() or ack.exception() is None:
+                return
+            with self._addingLock:
+                if self.nodesAdding.get(address) is not added:
+                    return
+                del self.nodesAdding[address]
+            added.set_exception(ack.exception())
+        ack.add_done_callback(acked)
+
+    def _prepareNode(self, node):
+        if node.address in self._nodes:
+            if node._driverStore is not None:
+                node.updateDrivers(self._nodes[node.address]['drivers'])
+            else:
+                node._drivers = self._nodes[node.address]['drivers']
+            node._indexDrivers()
+            for existing in node._drivers:
+                driver = node._findDriver('drivers', node.drivers, existing['driver'])
+                if driver is not None:
+                    driver['value'] = existing['value']
+                    # JIMBO SAYS NO
+                    # driver['uom'] = existing['uom']
+        self.nodes[node.address] = node
+        # if node.address not in self._nodes or update:
+
     """
     Forces a full overwrite of the node
     """
 
     def updateNode(self, node):
         self.nodes[node.address] = node
-        self.nodesAdding.append(node.address)
-        self.poly.addNode(node)
+        added = self._trackAdd(node.address)
+        self._watchAck(node.address, added, self.poly.addNode(node))
 
     def delNode(self, address):
         """
@@ -1032,7 +1894,59 @@ class Controller(Node):
         """
         if address in self.nodes:
             del self.nodes[address]
-        self.poly.delNode(address)
+        return self.poly.delNode(address)
+
+    def _poll(self, key):
+        started = time.time()
+        try:
+            return getattr(self, key)()
+        finally:
+            self._pollStats[key].record(time.time() - started)
+
+    def addPoll(self, name, callback, interval, jitter=0, offset=None):
+        """
+        Run callback every interval seconds from the local poll scheduler,
+        delayed by a random 0..jitter seconds each time. Polls with the same
+        interval are spread across it unless offset is given. A poll that is
+        still running when it is due again is skipped, not queued.
+        Nodes can use this for their own polls, e.g.
+        self.controller.addPoll(self.address, self.poll, 60, jitter=5)
+        """
+        if self.poller is None:
+            self.poller = PollScheduler(dispatcher=self._dispatcher)
+            self.poller.start()
+            self.poly.onStop(self.poller.stop)
+        return self.poller.add(name, callback, interval, jitter, offset)
+
+    def removePoll(self, name):
+        if self.poller is not None:
+            self.poller.remove(name)
+
+    def startPolling(self, shortPoll, longPoll=None, jitter=0):
+        """
+        Run shortPoll() and longPoll() from the local poll scheduler every
+        shortPoll and longPoll seconds. shortPoll and longPoll messages from
+        Polyglot are ignored from then on.
+        """
+        self._localPolls = True
+        self.addPoll('shortPoll', functools.partial(self._poll, 'shortPoll'),
+                     shortPoll, jitter, 0)
+        if longPoll:
+            self.addPoll('longPoll', functools.partial(self._poll, 'longPoll'),
+                         longPoll, jitter, 0)
+
+    def pollStats(self):
+        """
+        Run count, skipped runs and duration (last/avg/max seconds) of the
+        shortPoll and longPoll and of every poll in the local scheduler.
+        """
+        stats = dict((key, pollStats.asDict())
+                     for key, pollStats in self._pollStats.items())
+        if self.poller is not None:
+            stats.update(self.poller.stats())
+        for key, count in self.poly.pollsCoalesced.items():
+            stats[key]['coalesced'] = count
+        return stats
 
     def longPoll(self):
         pass
@@ -1138,6 +2052,3 @@ class Controller(Node):
 
 if __name__ == "__main__":
     sys.exit(0)
-
-if hasattr(main, '__file__'):
-    init_interface()
@@ -2,8 +2,64 @@
 import os
 import logging
 from logging import handlers as log_handlers
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import warnings
 
+
+class PolyQueueHandler(log_handlers.QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread and, when the
+    queue is full, either drops the record ('drop') or waits ('block').
+    """
+
+    def __init__(self, log_queue, policy='drop'):
+        log_handlers.QueueHandler.__init__(self, log_queue)
+        self.policy = policy
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if self.policy == 'block':
+            self.queue.put(record)
+        else:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+
+
+class PolyQueueListener(log_handlers.QueueListener):
+    """
+    QueueListener that waits for room for its stop marker, so stop() on a
+    full queue writes out what is queued instead of raising queue.Full.
+    """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class PolyFileHandler(log_handlers.TimedRotatingFileHandler):
+    """
+    Rotating file handler that opens the log file, creating its directory,
+    when the first record is written rather than when it is created.
+    """
+
+    def __init__(self, filename, **kwargs):
+        kwargs['delay'] = True
+        log_handlers.TimedRotatingFileHandler.__init__(self, filename, **kwargs)
+
+    def _open(self):
+        directory = os.path.dirname(self.baseFilename)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        return log_handlers.TimedRotatingFileHandler._open(self)
+
+
 class PolyLogger:
 
     NAME = __name__.split(".")[0]
@@ -15,15 +71,17 @@ class PolyLogger:
     BACKUP_COUNT = 30
     FMT_STRING = '%(asctime)s %(threadName)-10s %(name)-18s %(levelname)-8s %(module)s:%(funcName)s: %(message)s'
     IS_ROOT = True
+    QUEUE_SIZE = 10000
+    QUEUE_POLICY = 'drop'
 
     def __init__(self):
-        if not os.path.exists(PolyLogger.LOGS_DIR):
-            os.makedirs(PolyLogger.LOGS_DIR)
-        self.handler = log_handlers.TimedRotatingFileHandler(
+        self.handler = PolyFileHandler(
             os.path.join(PolyLogger.LOGS_DIR, PolyLogger.LOG_FILE),
             when=PolyLogger.ROTATION,
             backupCount=PolyLogger.BACKUP_COUNT
         )
+        self.queue_handler = None
+        self.listener = None
         logging.captureWarnings(True)
         self.set_log_format(PolyLogger.FMT_STRING)
         # Get our logger for everyone to use.
@@ -33,7 +91,7 @@ class PolyLogger:
         self.logger.addHandler(self.handler)
         self.logger.setLevel(PolyLogger.LEVEL)
         # By default we only show warnings for others.
-        self.set_basic_config(True,logging.WARNING)
+        self._basic_config(True, logging.WARNING)
         self.warnlog = logging.getLogger(PolyLogger.WARN_LOGGER_NAME)
         warnings.formatwarning = self.warning_on_one_line
         self.warnlog.addHandler(self.handler)
@@ -44,11 +102,26 @@ class PolyLogger:
         # Attach the formatter to the handler
         self.handler.setFormatter(formatter)
 
+    def set_log_file(self, file_name):
+        """ Write the log to file_name in LOGS_DIR from now on. """
+        self.handler.acquire()
+        try:
+            if self.handler.stream is not None:
+                self.handler.stream.close()
+                self.handler.stream = None
+            self.handler.baseFilename = os.path.abspath(
+                os.path.join(PolyLogger.LOGS_DIR, file_name))
+        finally:
+            self.handler.release()
+
     def set_basic_config(self, enable=True, level=None):
         self.logger.info('set_basic_config: enable={} level={}'.format(enable,level))
         if level is None:
             level = self.logger.getEffectiveLevel()
             self.logger.info('set_basic_config: level={}'.format(level))
+        self._basic_config(enable, level)
+
+    def _basic_config(self, enable, level):
         # Remove all handlers associated with the root logger object.
         # Once everyone is on Python 3.8 we could use basicConfig force
         # option instead
@@ -58,10 +131,58 @@ class PolyLogger:
         # Attach the handler to the logger
         if enable:
             logging.basicConfig(
-                handlers=[self.handler],
+                handlers=[self.queue_handler or self.handler],
                 level=level,
                 )
 
+    def enable_queue(self, size=None, policy=None):
+        """
+        Send log records through a bounded queue to a background thread that
+        formats them and writes the log file, so logging never waits on disk.
+        When the queue is full records are dropped ('drop', counted in
+        queue_stats()) or the caller waits ('block').
+        """
+        if self.listener is not None:
+            return
+        size = PolyLogger.QUEUE_SIZE if size is None else size
+        policy = PolyLogger.QUEUE_POLICY if policy is None else policy
+        self.queue_handler = PolyQueueHandler(queue.Queue(size), policy)
+        self.listener = PolyQueueListener(
+            self.queue_handler.queue, self.handler, respect_handler_level=True)
+        self.listener.start()
+        self._swap_handler(self.handler, self.queue_handler)
+
+    def disable_queue(self):
+        """
+        Write out everything still queued, stop the background thread and
+        log directly to the file again.
+        """
+        if self.listener is None:
+            return
+        self._swap_handler(self.queue_handler, self.handler)
+        self.listener.stop()
+        self.listener = None
+        self.handler.flush()
+        if self.queue_handler.dropped:
+            self.logger.warning('Dropped {} log records, queue was full'.format(
+                self.queue_handler.dropped))
+        self.queue_handler = None
+
+    def queue_stats(self):
+        if self.queue_handler is None:
+            return None
+        return {
+            'queued': self.queue_handler.queue.qsize(),
+            'dropped': self.queue_handler.dropped,
+            'policy': self.queue_handler.policy,
+        }
+
+    def _swap_handler(self, old, new):
+        for logger in (self.logger, self.warnlog, logging.root):
+            if old in logger.handlers:
+                logger.removeHandler(old)
+                logger.addHandler(new)
+
     @staticmethod
     def warning_on_one_line(message, category, filename, lineno, file=None, line=None):
         return '{}:{}: {}: {}'.format(filename, lineno, category.__name__, message)
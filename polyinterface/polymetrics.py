@@ -0,0 +1,190 @@
+"""
+Lightweight runtime metrics.
+
+Counters, gauges and fixed bucket histograms kept in a registry that can
+render a Prometheus text format snapshot and periodically write it to a
+file in the log directory. METRICS is the registry used by the interface.
+"""
+
+import os
+from threading import Lock, Thread, Event
+from .polylogger import LOGGER, PolyLogger
+
+# Default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _formatLabels(labels, extra=None):
+    items = list(labels)
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in items) + '}'
+
+
+def _formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """ Monotonic counter. fn, if given, is called for the value instead. """
+    __slots__ = ('_value', '_lock', '_fn')
+    type = 'counter'
+
+    def __init__(self, fn=None):
+        self._value = 0
+        self._lock = Lock()
+        self._fn = fn
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def get(self):
+        return self._fn() if self._fn is not None else self._value
+
+    def samples(self, name, labels):
+        yield name + _formatLabels(labels), self.get()
+
+
+class Gauge(Counter):
+    """ Value that can go up and down. fn, if given, is called for the value. """
+    __slots__ = ()
+    type = 'gauge'
+
+    def set(self, value):
+        self._value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class Histogram(object):
+    """ Histogram with fixed upper bounds. """
+    __slots__ = ('buckets', '_counts', '_sum', '_count', '_lock')
+    type = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * len(self.buckets)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._sum += value
+            self._count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+            count = self._count
+        cumulative = 0
+        for bound, bucketCount in zip(self.buckets, counts):
+            cumulative += bucketCount
+            yield name + '_bucket' + _formatLabels(labels, ('le', _formatValue(float(bound)))), cumulative
+        yield name + '_bucket' + _formatLabels(labels, ('le', '+Inf')), count
+        yield name + '_sum' + _formatLabels(labels), total
+        yield name + '_count' + _formatLabels(labels), count
+
+
+class MetricsRegistry(object):
+    """
+    Holds metric families by name. counter(), gauge() and histogram() return
+    the existing metric for a name and label set or create it, so callers
+    can look a metric up once and keep it.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._families = {}
+        self._exportStop = None
+
+    def _get(self, cls, name, help, labels, *args):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = [cls.type, help, {}]
+            elif family[0] != cls.type:
+                raise ValueError('metric {} is a {}'.format(name, family[0]))
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = cls(*args)
+            return metric
+
+    def counter(self, name, help='', fn=None, **labels):
+        return self._get(Counter, name, help, labels, fn)
+
+    def gauge(self, name, help='', fn=None, **labels):
+        return self._get(Gauge, name, help, labels, fn)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def render(self):
+        """ Prometheus text exposition format snapshot of all metrics. """
+        with self._lock:
+            families = sorted((name, family[0], family[1], list(family[2].items()))
+                              for name, family in self._families.items())
+        lines = []
+        for name, type, help, metrics in families:
+            if help:
+                lines.append('# HELP {} {}'.format(name, help.replace('\n', ' ')))
+            lines.append('# TYPE {} {}'.format(name, type))
+            for labels, metric in sorted(metrics, key=lambda m: m[0]):
+                try:
+                    for sample, value in metric.samples(name, labels):
+                        lines.append('{} {}'.format(sample, _formatValue(value)))
+                except Exception as err:
+                    LOGGER.error('metrics: failed to read {}: {}'.format(name, err))
+        return '\n'.join(lines) + '\n'
+
+    def writeFile(self, fileName='metrics.prom'):
+        """ Write a snapshot to fileName in PolyLogger.LOGS_DIR. """
+        path = os.path.join(PolyLogger.LOGS_DIR, fileName)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+        return path
+
+    def startFileExport(self, interval=60, fileName='metrics.prom'):
+        """ Write a snapshot to the log directory every interval seconds. """
+        self.stopFileExport()
+        stop = self._exportStop = Event()
+
+        def export():
+            while not stop.wait(interval):
+                try:
+                    self.writeFile(fileName)
+                except (IOError, OSError) as err:
+                    LOGGER.error('metrics: failed to write {}: {}'.format(fileName, err))
+
+        thread = Thread(target=export, name='Metrics')
+        thread.daemon = True
+        thread.start()
+
+    def stopFileExport(self):
+        if self._exportStop is not None:
+            self._exportStop.set()
+            self._exportStop = None
+
+
+METRICS = MetricsRegistry()
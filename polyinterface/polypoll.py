@@ -0,0 +1,178 @@
+"""
+Local poll scheduler.
+
+Runs poll callbacks at fixed intervals without waiting for shortPoll and
+longPoll messages from Polyglot. Jobs sharing an interval are spread over
+it, each run can be jittered, and a run that is due while the previous run
+of the same job is still going is skipped instead of queued.
+"""
+
+import heapq
+import random
+from threading import Condition, Thread
+import time
+from .polylogger import LOGGER
+from .polydispatch import KeyedDispatcher
+
+# Successive multiples of this fraction are evenly spread over [0, 1)
+_SPREAD = 0.6180339887498949
+
+
+class PollStats(object):
+    """ Run count and duration of a poll. """
+    __slots__ = ('runs', 'skipped', 'last', 'total', 'max')
+
+    def __init__(self):
+        self.runs = 0
+        self.skipped = 0
+        self.last = 0.0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, duration):
+        self.runs += 1
+        self.last = duration
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def asDict(self):
+        return {
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'last': self.last,
+            'avg': self.total / self.runs if self.runs else 0.0,
+            'max': self.max,
+        }
+
+
+class PollJob(object):
+    """ A callback scheduled by PollScheduler. """
+
+    def __init__(self, name, callback, interval, jitter):
+        self.name = name
+        self.callback = callback
+        self.interval = float(interval)
+        self.jitter = float(jitter)
+        self.due = 0.0
+        self.running = False
+        self.cancelled = False
+        self.stats = PollStats()
+
+
+class PollScheduler(object):
+    """
+    Schedules PollJobs and runs them on a KeyedDispatcher keyed by job name,
+    so each job never runs concurrently with itself.
+
+    :param dispatcher: KeyedDispatcher to run the jobs on, by default a
+        private one with workers threads.
+    """
+
+    def __init__(self, dispatcher=None, workers=2, name='Poll'):
+        self.name = name
+        self._ownDispatcher = dispatcher is None
+        self._dispatcher = dispatcher or KeyedDispatcher(
+            workers, name='{}Worker'.format(name))
+        self._cond = Condition()
+        self._heap = []
+        self._jobs = {}
+        self._seq = 0
+        self._spread = {}
+        self._running = False
+        self._thread = None
+
+    def add(self, name, callback, interval, jitter=0, offset=None):
+        """
+        Run callback() every interval seconds. Each run is delayed by a
+        random 0..jitter seconds. The first run is at offset seconds, by
+        default jobs with the same interval are spread across it.
+        Replaces an existing job with the same name.
+        """
+        job = PollJob(name, callback, interval, jitter)
+        if offset is None:
+            count = self._spread.get(job.interval, 0)
+            self._spread[job.interval] = count + 1
+            offset = ((count * _SPREAD) % 1.0) * job.interval
+        job.due = time.time() + offset
+        with self._cond:
+            old = self._jobs.get(name)
+            if old is not None:
+                old.cancelled = True
+            self._jobs[name] = job
+            self._push(job)
+        return job
+
+    def remove(self, name):
+        with self._cond:
+            job = self._jobs.pop(name, None)
+            if job is not None:
+                job.cancelled = True
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop scheduling polls, and the dispatcher if it is our own. """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._ownDispatcher:
+            self._dispatcher.stop()
+
+    def stats(self):
+        """ Poll statistics per job name. """
+        with self._cond:
+            return dict((name, job.stats.asDict())
+                        for name, job in self._jobs.items())
+
+    def _push(self, job):
+        self._seq += 1
+        when = job.due + (random.uniform(0, job.jitter) if job.jitter else 0)
+        heapq.heappush(self._heap, (when, self._seq, job))
+        self._cond.notify()
+
+    def _run(self):
+        with self._cond:
+            while self._running:
+                now = time.time()
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                when, _, job = self._heap[0]
+                if when > now:
+                    self._cond.wait(when - now)
+                    continue
+                heapq.heappop(self._heap)
+                if job.cancelled:
+                    continue
+                if job.running:
+                    job.stats.skipped += 1
+                    LOGGER.debug('{}: skipping {}, previous run still active'.format(
+                        self.name, job.name))
+                else:
+                    job.running = True
+                    self._dispatcher.submit(job.name, self._runJob, job)
+                # Schedule from the planned time so there is no drift, but
+                # never queue up runs that were missed.
+                job.due += job.interval
+                if job.due <= now:
+                    missed = int((now - job.due) // job.interval) + 1
+                    job.stats.skipped += missed
+                    job.due += missed * job.interval
+                self._push(job)
+
+    def _runJob(self, job):
+        started = time.time()
+        try:
+            job.callback()
+        finally:
+            with self._cond:
+                job.running = False
+                job.stats.record(time.time() - started)
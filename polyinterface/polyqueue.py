@@ -0,0 +1,156 @@
+"""
+Priority input queue.
+
+Input from Polyglot is sorted into lanes by message key so interactive
+commands don't wait behind poll and query work. Lanes are served by
+weighted round robin in priority order: a lane with weight 8 gets up to 8
+items for every 1 of a lane with weight 1 while both have work, so low
+lanes are slowed down but never starved. Items that waited longer than
+maxWait seconds are served first regardless of their lane.
+
+PriorityInputQueue has the part of queue.Queue's API the interface uses.
+"""
+
+from collections import deque
+from threading import Condition
+import time
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+# Lane name and the input keys it carries, highest priority first
+LANES = (
+    ('command', ('command', 'delete', 'setLogLevel')),
+    ('addnode', ('addnode',)),
+    ('query', ('query', 'status')),
+    ('poll', ('shortPoll', 'longPoll')),
+)
+
+DEFAULT_WEIGHTS = {'command': 8, 'addnode': 4, 'query': 2, 'poll': 1}
+
+
+class PriorityInputQueue(object):
+    """
+    :param weights: Dict of lane name to weight, missing lanes get 1.
+    :param maxWait: Seconds after which an item is served before anything
+        else, None to rely on the weights only.
+    """
+
+    def __init__(self, weights=None, maxWait=None):
+        weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.lanes = [name for name, _ in LANES]
+        self._weights = [max(1, int(weights.get(name, 1))) for name in self.lanes]
+        self._credits = list(self._weights)
+        self._laneOf = {}
+        for index, (_, keys) in enumerate(LANES):
+            for key in keys:
+                self._laneOf[key] = index
+        self._items = [deque() for _ in self.lanes]
+        self._size = 0
+        self.maxWait = maxWait
+        self.unfinished_tasks = 0
+        self.mutex = Condition()
+        self.not_empty = self.mutex
+        self.all_tasks_done = Condition(self.mutex)
+        self._served = [0] * len(self.lanes)
+        self._promoted = 0
+
+    def _lane(self, item):
+        """ Highest priority lane of the keys in item. """
+        lane = None
+        try:
+            for key in item:
+                index = self._laneOf.get(key, 0)
+                if lane is None or index < lane:
+                    lane = index
+        except TypeError:
+            pass
+        return lane or 0
+
+    def put(self, item, block=True, timeout=None):
+        with self.mutex:
+            self._items[self._lane(item)].append((time.time(), item))
+            self._size += 1
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def put_nowait(self, item):
+        self.put(item, False)
+
+    def _next(self):
+        if self.maxWait is not None:
+            oldest = None
+            for index, items in enumerate(self._items):
+                if items and (oldest is None or items[0][0] < self._items[oldest][0][0]):
+                    oldest = index
+            if time.time() - self._items[oldest][0][0] >= self.maxWait:
+                if any(self._items[i] for i in range(oldest)):
+                    self._promoted += 1
+                return oldest
+        for refill in (False, True):
+            if refill:
+                self._credits = list(self._weights)
+            for index, items in enumerate(self._items):
+                if items and self._credits[index] > 0:
+                    self._credits[index] -= 1
+                    return index
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if not block:
+                if not self._size:
+                    raise Empty
+            elif timeout is None:
+                while not self._size:
+                    self.not_empty.wait()
+            else:
+                deadline = time.time() + timeout
+                while not self._size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+            lane = self._next()
+            self._size -= 1
+            self._served[lane] += 1
+            return self._items[lane].popleft()[1]
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def task_done(self):
+        with self.all_tasks_done:
+            unfinished = self.unfinished_tasks - 1
+            if unfinished < 0:
+                raise ValueError('task_done() called too many times')
+            self.unfinished_tasks = unfinished
+            if not unfinished:
+                self.all_tasks_done.notify_all()
+
+    def join(self):
+        with self.all_tasks_done:
+            while self.unfinished_tasks:
+                self.all_tasks_done.wait()
+
+    def qsize(self):
+        return self._size
+
+    def empty(self):
+        return not self._size
+
+    def full(self):
+        return False
+
+    def laneSize(self, lane):
+        return len(self._items[self.lanes.index(lane)])
+
+    def stats(self):
+        """ Queued and served items per lane and items promoted for waiting too long. """
+        with self.mutex:
+            return {
+                'lanes': dict((name, {'queued': len(self._items[i]), 'served': self._served[i]})
+                              for i, name in enumerate(self.lanes)),
+                'promoted': self._promoted,
+            }
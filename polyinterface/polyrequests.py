@@ -0,0 +1,147 @@
+"""
+Correlation of requests sent to Polyglot with its responses.
+
+Polyglot's responses carry no request id, so requests are matched by kind
+(addnode, removenode, custom, set) and key (node address, custom key or
+(address, driver)). A response resolves every request waiting on its kind
+and key, which is also what coalesced and debounced sends need. Requests
+without a response within their timeout fail with
+concurrent.futures.TimeoutError, requests Polyglot reports as failed with
+RequestError.
+"""
+
+from concurrent import futures
+import heapq
+from threading import Condition, Thread
+import time
+from .polylogger import LOGGER
+from .polymetrics import METRICS
+
+
+class RequestError(Exception):
+    """ Polyglot rejected a request, result is its response. """
+
+    def __init__(self, message, result=None):
+        Exception.__init__(self, message)
+        self.result = result
+
+
+class PendingRequests(object):
+    """
+    :param timeout: Default seconds to wait for a response, None waits
+        forever.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._lock = Condition()
+        self._pending = {}
+        self._deadlines = []
+        self._seq = 0
+        self._thread = None
+        self._latency = {}
+        self.stats = {'tracked': 0, 'resolved': 0, 'timedOut': 0}
+
+    def track(self, kind, key, timeout=None):
+        """ Return a Future resolved with the response for kind and key. """
+        future = futures.Future()
+        timeout = self.timeout if timeout is None else timeout
+        sent = time.time()
+        with self._lock:
+            self._pending.setdefault((kind, key), []).append((sent, future))
+            self.stats['tracked'] += 1
+            if timeout is not None:
+                self._seq += 1
+                heapq.heappush(self._deadlines, (sent + timeout, self._seq, kind, key, future))
+                if self._thread is None:
+                    self._thread = Thread(target=self._expire, name='Requests')
+                    self._thread.daemon = True
+                    self._thread.start()
+                self._lock.notify()
+        return future
+
+    def resolve(self, kind, key, result, after=None):
+        """
+        Resolve the requests waiting on kind and key, only those tracked
+        later than time after if given. Returns how many were resolved.
+        """
+        waiting = self._take(kind, key, after)
+        now = time.time()
+        latency = self._histogram(kind)
+        for sent, future in waiting:
+            if _setResult(future, result):
+                latency.observe(now - sent)
+        return len(waiting)
+
+    def reject(self, kind, key, exception, after=None):
+        """ Like resolve() but fail the requests with exception. """
+        waiting = self._take(kind, key, after)
+        for sent, future in waiting:
+            _setException(future, exception)
+        return len(waiting)
+
+    def _take(self, kind, key, after):
+        with self._lock:
+            waiting = self._pending.pop((kind, key), None)
+            if waiting and after is not None:
+                older = [entry for entry in waiting if entry[0] <= after]
+                waiting = [entry for entry in waiting if entry[0] > after]
+                if older:
+                    self._pending[(kind, key)] = older
+            if not waiting:
+                return []
+            self.stats['resolved'] += len(waiting)
+            return waiting
+
+    def pending(self):
+        with self._lock:
+            return sum(len(waiting) for waiting in self._pending.values())
+
+    def _histogram(self, kind):
+        histogram = self._latency.get(kind)
+        if histogram is None:
+            histogram = self._latency[kind] = METRICS.histogram(
+                'polyinterface_request_latency_seconds',
+                'Time from sending a request to Polyglot to its response', kind=kind)
+        return histogram
+
+    def _expire(self):
+        while True:
+            with self._lock:
+                while not self._deadlines or self._deadlines[0][0] > time.time():
+                    self._lock.wait(self._deadlines[0][0] - time.time() if self._deadlines else None)
+                deadline, _, kind, key, future = heapq.heappop(self._deadlines)
+                if future.done():
+                    continue
+                waiting = self._pending.get((kind, key), [])
+                for i, entry in enumerate(waiting):
+                    if entry[1] is future:
+                        del waiting[i]
+                        break
+                if not waiting:
+                    self._pending.pop((kind, key), None)
+                self.stats['timedOut'] += 1
+            LOGGER.warning('No response from Polyglot for {} {}'.format(kind, key))
+            METRICS.counter('polyinterface_request_timeouts_total',
+                            'Requests Polyglot did not respond to in time', kind=kind).inc()
+            _setException(future, futures.TimeoutError(
+                '{} {} was not acknowledged'.format(kind, key)))
+
+
+def _setResult(future, result):
+    if future.done():
+        return False
+    try:
+        future.set_result(result)
+        return True
+    except futures.InvalidStateError:
+        return False
+
+
+def _setException(future, exception):
+    if future.done():
+        return
+    try:
+        future.set_exception(exception)
+    except futures.InvalidStateError:
+        pass
@@ -0,0 +1,432 @@
+"""
+Sharded multi-process runtime.
+
+ShardedController runs nodes in SHARDS worker processes so CPU bound node
+code (protocol decoding, polling) scales across cores instead of sharing
+one interpreter. The parent process keeps the single MQTT connection in
+Interface. Each node lives in the worker picked by a crc32 hash of its
+address and is represented in the parent by a RemoteNode: commands,
+query, status, start and polls for the node are forwarded to its worker
+over a pipe and run there in order, and whatever the worker's nodes send
+(setDriver, reportDrivers, reportCmd) comes back over the pipe and is sent
+by the parent's Interface, with its batching and buffering.
+
+Workers are started with the 'spawn' method, so node classes and their
+arguments must be picklable and importable: define them at module level
+and keep the main script's start up code under if __name__ == '__main__'.
+Node code in a worker sees a stand-in controller with poly.send and
+poly.getDriver only.
+"""
+
+from concurrent import futures
+from copy import deepcopy
+import functools
+import itertools
+import multiprocessing
+from threading import Lock, Thread
+import zlib
+from .polylogger import LOGGER, LOG_HANDLER
+from .polymetrics import METRICS
+from .polyinterface import Controller, Node
+
+
+def shardFor(address, shards):
+    """ Worker index for a node address, the same in every process. """
+    return (zlib.crc32(address.encode('utf-8')) & 0xffffffff) % shards
+
+
+class Shard(object):
+    """
+    Parent side of a worker process. When the worker dies the shard is
+    marked dead, posts to it fail right away with OSError and onExit, if
+    set, is called with the shard. onReport, if set, is called with the
+    (address, driver, value, uom) of driver values the worker's nodes sent.
+    """
+
+    def __init__(self, index, context, logFile=None):
+        self.index = index
+        self.nodes = 0
+        self.stats = {'sent': 0, 'received': 0, 'restarts': 0}
+        self.dead = True
+        self.onExit = None
+        self.onReport = None
+        self._context = context
+        self._logFile = logFile
+        self._stopping = False
+        self._sendLock = Lock()
+        self._requests = {}
+        self._ids = itertools.count(1)
+        self._reader = None
+        self.conn = None
+        self.process = None
+
+    def start(self, poly):
+        """ Start (or restart) the worker process and the reader thread. """
+        self.conn, child = self._context.Pipe()
+        self.process = self._context.Process(
+            target=_workerMain, args=(child, self._logFile), name='Shard-{}'.format(self.index))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.dead = False
+        self._reader = Thread(target=self._read, args=(self.conn, poly),
+                              name='Shard-{}'.format(self.index))
+        self._reader.daemon = True
+        self._reader.start()
+
+    def post(self, *message):
+        if self.dead:
+            raise OSError('Shard {} is not running'.format(self.index))
+        with self._sendLock:
+            self.conn.send(message)
+            self.stats['sent'] += 1
+
+    def trySend(self, *message):
+        """ post() that logs instead of raising when the worker is gone. """
+        try:
+            self.post(*message)
+            return True
+        except (OSError, ValueError) as err:
+            LOGGER.error('Shard {}: {} not delivered: {}'.format(self.index, message[0], err))
+            return False
+
+    def request(self, op, *args):
+        """ Post a message answered by the worker, returns a Future. """
+        future = futures.Future()
+        requestId = next(self._ids)
+        self._requests[requestId] = future
+        try:
+            self.post(op, requestId, *args)
+        except (OSError, ValueError) as err:
+            self._requests.pop(requestId, None)
+            future.set_exception(err)
+        return future
+
+    def _read(self, conn, poly):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            self.stats['received'] += 1
+            if message[0] == 'send':
+                poly.send(message[1], message[2])
+                if message[3] and self.onReport is not None:
+                    self.onReport(message[3])
+            elif message[0] == 'result':
+                future = self._requests.pop(message[1], None)
+                if future is None:
+                    continue
+                if message[3] is None:
+                    future.set_result(message[2])
+                else:
+                    future.set_exception(RuntimeError(message[3]))
+        self.dead = True
+        for future in list(self._requests.values()):
+            future.set_exception(RuntimeError('Shard {} exited'.format(self.index)))
+        self._requests.clear()
+        if self._stopping:
+            return
+        self.process.join(1)
+        LOGGER.error('Shard {} exited with {}'.format(self.index, self.process.exitcode))
+        if self.onExit is not None:
+            self.onExit(self)
+
+    def alive(self):
+        return not self.dead and self.process.is_alive()
+
+    def stop(self, timeout=5):
+        self._stopping = True
+        try:
+            self.post('stop')
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class RemoteNode(Node):
+    """ Parent process stand-in for a node running in a shard. """
+
+    def __init__(self, controller, shard, spec, description):
+        Node.__init__(self, controller, description['primary'],
+                      description['address'], description['name'])
+        self.shard = shard
+        self.spec = spec
+        self.id = description['id']
+        self.hint = description['hint']
+        self.drivers = description['drivers']
+        self._drivers = deepcopy(self.drivers)
+        self._indexDrivers()
+
+    def _call(self, method, *args):
+        self.shard.trySend('call', self.address, method, args)
+
+    def syncDrivers(self):
+        """
+        Give the worker's node the current and reported values kept here,
+        when it is added or recreated.
+        """
+        self.shard.trySend('drivers', self.address,
+                           [dict(d) for d in self.drivers],
+                           [dict(d) for d in self._drivers])
+
+    def updateDrivers(self, drivers):
+        # Reported values from a new config, the worker keeps its current ones
+        Node.updateDrivers(self, drivers)
+        self.shard.trySend('drivers', self.address, None,
+                           [dict(d) for d in self._drivers])
+
+    def _reported(self, driver, value, uom):
+        """ Record a value the worker's node sent, for syncDrivers. """
+        Node.setDriver(self, driver, value, False, False, uom)
+        entry = self._findDriver('_drivers', self._drivers, driver)
+        if entry is not None:
+            entry['value'] = value
+            entry['uom'] = uom
+
+    def runCmd(self, command):
+        self._call('runCmd', command)
+
+    def query(self):
+        self._call('query')
+
+    def status(self):
+        self._call('status')
+
+    def reportDrivers(self):
+        self._call('reportDrivers')
+
+    def start(self):
+        self._call('start')
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None):
+        Node.setDriver(self, driver, value, False, False, uom)
+        self._call('setDriver', driver, value, report, force, uom)
+
+
+class ShardedController(Controller):
+    """
+    Controller that runs nodes created with createNode/createNodes in
+    SHARDS worker processes. With SHARDS = 0 nodes are created and run in
+    this process as usual. SHARD_LOG_FILES writes each worker's log to
+    debug-shard<n>.log next to debug.log. With SHARD_RESTART a worker that
+    dies is started again and its nodes are created, given the last
+    driver values they sent and started again.
+    """
+    SHARDS = 0
+    SHARD_TIMEOUT = 30
+    SHARD_LOG_FILES = True
+    SHARD_RESTART = True
+
+    def __init__(self, poly, name='Controller'):
+        self.shards = []
+        Controller.__init__(self, poly, name)
+        if self.SHARDS > 0:
+            context = multiprocessing.get_context('spawn')
+            for index in range(self.SHARDS):
+                logFile = 'debug-shard{}.log'.format(index) if self.SHARD_LOG_FILES else None
+                shard = Shard(index, context, logFile)
+                shard.onExit = self._shardExited
+                shard.onReport = self._shardReported
+                shard.start(self.poly)
+                self.shards.append(shard)
+                METRICS.gauge('polyinterface_shard_nodes', 'Nodes running in a shard worker process',
+                              fn=functools.partial(getattr, shard, 'nodes'), shard=str(index))
+                METRICS.gauge('polyinterface_shard_up', 'Shard worker process running',
+                              fn=functools.partial(lambda s: 0 if s.dead else 1, shard), shard=str(index))
+            self.poly.onStop(self.stopShards)
+            LOGGER.info('Started {} shard processes'.format(len(self.shards)))
+
+    def shardFor(self, address):
+        return self.shards[shardFor(address, len(self.shards))]
+
+    def createNode(self, nodeClass, primary, address, name, *args):
+        """
+        Create nodeClass(controller, primary, address, name, *args) in the
+        shard for address. Returns the RemoteNode for it, to be added with
+        addNode or addNodes.
+        """
+        return self.createNodes([(nodeClass, primary, address, name) + args])[0]
+
+    def createNodes(self, specs):
+        """
+        Create many nodes, each spec a (nodeClass, primary, address, name,
+        *args) tuple. The workers build them in parallel.
+        """
+        specs = list(specs)
+        if not self.shards:
+            return [spec[0](self, *spec[1:]) for spec in specs]
+        pending = []
+        for spec in specs:
+            shard = self.shardFor(spec[2])
+            pending.append((shard, spec, self._requestCreate(shard, spec)))
+        nodes = []
+        for shard, spec, future in pending:
+            nodes.append(RemoteNode(self, shard, spec, future.result(self.SHARD_TIMEOUT)))
+            shard.nodes += 1
+        return nodes
+
+    def _requestCreate(self, shard, spec):
+        return shard.request('create', spec[0], spec[1], spec[2], spec[3], tuple(spec[4:]))
+
+    def _shardReported(self, reports):
+        """ Called on a shard's reader thread with the values its nodes sent. """
+        for address, driver, value, uom in reports:
+            node = self.nodes.get(address)
+            if isinstance(node, RemoteNode):
+                node._reported(driver, value, uom)
+
+    def _shardExited(self, shard):
+        """ Called on the shard's reader thread when its worker died. """
+        if not self.SHARD_RESTART or self.poly._stopping.is_set():
+            return
+        nodes = [node for node in list(self.nodes.values())
+                 if isinstance(node, RemoteNode) and node.shard is shard]
+        LOGGER.warning('Restarting shard {} with {} nodes'.format(shard.index, len(nodes)))
+        shard.stats['restarts'] += 1
+        shard.start(self.poly)
+        created = [(node, self._requestCreate(shard, node.spec)) for node in nodes]
+        for node, future in created:
+            try:
+                future.result(self.SHARD_TIMEOUT)
+            except Exception as err:
+                LOGGER.error('Shard {}: failed to recreate {}: {}'.format(
+                    shard.index, node.address, err))
+                continue
+            node.syncDrivers()
+            if node.address not in self.nodesAdding:
+                node.start()
+
+    def _prepareNode(self, node):
+        Controller._prepareNode(self, node)
+        if isinstance(node, RemoteNode):
+            # Hand the values merged from the Polyglot config to the worker
+            node.syncDrivers()
+
+    def delNode(self, address):
+        node = self.nodes.get(address)
+        if isinstance(node, RemoteNode):
+            node.shard.trySend('remove', address)
+            node.shard.nodes -= 1
+        return Controller.delNode(self, address)
+
+    def _poll(self, key):
+        """ Run the Controller's poll here and the nodes' polls in the shards. """
+        for shard in self.shards:
+            shard.trySend('poll', key)
+        return Controller._poll(self, key)
+
+    def shardStats(self):
+        return [dict(shard.stats, index=shard.index, pid=shard.process.pid,
+                     alive=shard.alive(), nodes=shard.nodes)
+                for shard in self.shards]
+
+    def stopShards(self):
+        for shard in self.shards:
+            shard.stop()
+
+
+class ShardPoly(object):
+    """ Stands in for the Interface in a worker, sends go to the parent. """
+    TRACK_DRIVER_SETS = False
+
+    def __init__(self, conn, nodes):
+        self._conn = conn
+        self._lock = Lock()
+        self.nodes = nodes
+
+    def post(self, *message):
+        with self._lock:
+            self._conn.send(message)
+
+    def send(self, message, type):
+        # Driver values go along unformatted so the parent's RemoteNode
+        # can keep them for a restart
+        reports = []
+        if type == 'status' and isinstance(message.get('set'), list):
+            for item in message['set']:
+                node = self.nodes.get(item.get('address'))
+                entry = None if node is None else node._findDriver('drivers', node.drivers, item.get('driver'))
+                if entry is not None:
+                    reports.append((item['address'], item['driver'], entry['value'], item['uom']))
+        self.post('send', message, type, reports)
+
+    def getDriver(self, address, driver):
+        node = self.nodes.get(address)
+        if node is None:
+            return None
+        entry = node._findDriver('_drivers', node._drivers, driver)
+        return None if entry is None else entry['value']
+
+
+class ShardController(object):
+    """ Stands in for the Controller of nodes in a worker. """
+    address = 'controller'
+
+    def __init__(self, poly):
+        self.poly = poly
+        self.nodes = poly.nodes
+
+
+def _describe(node):
+    return {
+        'address': node.address,
+        'name': node.name,
+        'primary': node.primary,
+        'id': node.id,
+        'hint': node.hint,
+        'drivers': [dict(d) for d in node.drivers],
+    }
+
+
+def _workerMain(conn, logFile):
+    if logFile:
+        LOG_HANDLER.set_log_file(logFile)
+    poly = ShardPoly(conn, {})
+    controller = ShardController(poly)
+    nodes = poly.nodes
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        op = message[0]
+        if op == 'stop':
+            break
+        try:
+            if op == 'create':
+                requestId, nodeClass, primary, address, name, args = message[1:]
+                try:
+                    node = nodes[address] = nodeClass(controller, primary, address, name, *args)
+                    poly.post('result', requestId, _describe(node), None)
+                except Exception as err:
+                    LOGGER.error('Shard: failed to create {}: {}'.format(address, err), exc_info=True)
+                    poly.post('result', requestId, None, str(err))
+            elif op == 'call':
+                address, method, args = message[1:]
+                if address in nodes:
+                    getattr(nodes[address], method)(*args)
+                else:
+                    LOGGER.error('Shard: {} for a node that is not here: {}'.format(method, address))
+            elif op == 'drivers':
+                address, drivers, reported = message[1:]
+                node = nodes.get(address)
+                if node is not None:
+                    for d in drivers or []:
+                        node.setDriver(d['driver'], d['value'], False)
+                    node.updateDrivers(reported)
+            elif op == 'poll':
+                for node in list(nodes.values()):
+                    poll = getattr(node, message[1], None)
+                    if callable(poll):
+                        try:
+                            poll()
+                        except Exception as err:
+                            LOGGER.error('Shard: {}.{} failed: {}'.format(
+                                node.address, message[1], err), exc_info=True)
+            elif op == 'remove':
+                nodes.pop(message[1], None)
+        except Exception as err:
+            LOGGER.error('Shard: {} failed: {}'.format(op, err), exc_info=True)
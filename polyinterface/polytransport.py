@@ -0,0 +1,186 @@
+"""
+Transports carry the MQTT traffic of an Interface.
+
+A transport is any object with the part of paho's Client API the Interface
+uses (see Transport). paho's Client is the default; LoopbackTransport keeps
+everything in memory so node servers can be driven without a broker in
+tests, benchmarks or when embedding.
+"""
+
+from abc import ABC, abstractmethod
+from collections import deque
+from threading import Event, Lock
+
+# paho's result codes, so transports don't need paho installed
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+
+
+class MessageInfo(object):
+    """ Result of publish(), like paho's MQTTMessageInfo. """
+    __slots__ = ('rc', 'mid')
+
+    def __init__(self, rc=MQTT_ERR_SUCCESS, mid=0):
+        self.rc = rc
+        self.mid = mid
+
+
+class Message(object):
+    """ Received message, like paho's MQTTMessage. """
+    __slots__ = ('topic', 'payload', 'qos', 'retain')
+
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class Transport(ABC):
+    """
+    Abstract base class of what Interface needs from a transport. Subclasses
+    implement the abstract methods; paho's Client has the same API without
+    subclassing it. Callbacks use paho's signatures:
+
+        on_connect(transport, userdata, flags, rc)
+        on_message(transport, userdata, message)
+        on_subscribe(transport, userdata, mid, granted_qos)
+        on_disconnect(transport, userdata, rc)
+        on_publish(transport, userdata, mid)
+        on_log(transport, userdata, level, string)
+
+    publish() returns an object with an rc attribute, MQTT_ERR_NO_CONN when
+    the message could not be sent.
+    """
+    on_connect = None
+    on_message = None
+    on_subscribe = None
+    on_disconnect = None
+    on_publish = None
+    on_log = None
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def tls_set_context(self, context=None):
+        pass
+
+    @abstractmethod
+    def connect_async(self, host, port=1883, keepalive=60):
+        """ Remember where to connect, loop_forever() connects. """
+
+    @abstractmethod
+    def loop_forever(self):
+        """
+        Connect and run until disconnect() is called or the connection is
+        lost, without reconnecting.
+        """
+
+    def loop_stop(self):
+        pass
+
+    @abstractmethod
+    def disconnect(self):
+        """ Close the connection, calling on_disconnect with rc 0. """
+
+    @abstractmethod
+    def reconnect(self):
+        """ Connect again to the same broker. """
+
+    @abstractmethod
+    def subscribe(self, topic, qos=0):
+        """ Returns (result, mid). """
+
+    @abstractmethod
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """ Returns a MessageInfo like object. """
+
+
+def pahoTransport(clientId):
+    """
+    The default transport, a paho MQTT client. Its own reconnect is off,
+    Interface retries with its ReconnectPolicy when loop_forever returns.
+    """
+    import paho.mqtt.client as mqtt
+    return mqtt.Client(clientId, True, reconnect_on_failure=False)
+
+
+class LoopbackTransport(Transport):
+    """
+    In memory transport. Published messages are passed to onPublish(topic,
+    payload) if given and kept in published (the last maxPublished of
+    them). deliver() hands a payload to the Interface as if it came from
+    Polyglot, on the calling thread.
+    """
+
+    def __init__(self, onPublish=None, maxPublished=1000):
+        self.onPublish = onPublish
+        self.published = deque(maxlen=maxPublished)
+        self.connected = False
+        self.subscriptions = []
+        self._mid = 0
+        self._lock = Lock()
+        self._stopped = Event()
+
+    def connect_async(self, host, port=1883, keepalive=60):
+        self._stopped.clear()
+
+    def loop_forever(self):
+        self._connect()
+        self._stopped.wait()
+
+    def loop_stop(self):
+        self._stopped.set()
+
+    def disconnect(self):
+        self.connected = False
+        self._stopped.set()
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, 0)
+
+    def reconnect(self):
+        self._connect()
+
+    def drop(self, rc=1):
+        """ Simulate losing the connection to the broker. """
+        self.connected = False
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, rc)
+        self._stopped.set()
+
+    def _connect(self):
+        self.connected = True
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+
+    def _nextMid(self):
+        with self._lock:
+            self._mid += 1
+            return self._mid
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.append(topic)
+        mid = self._nextMid()
+        if self.on_subscribe is not None:
+            self.on_subscribe(self, None, mid, (qos,))
+        return (MQTT_ERR_SUCCESS, mid)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if not self.connected:
+            return MessageInfo(MQTT_ERR_NO_CONN)
+        mid = self._nextMid()
+        self.published.append((topic, payload))
+        if self.onPublish is not None:
+            self.onPublish(topic, payload)
+        if self.on_publish is not None:
+            self.on_publish(self, None, mid)
+        return MessageInfo(MQTT_ERR_SUCCESS, mid)
+
+    def deliver(self, payload, topic=None):
+        """ Deliver a payload (bytes, str or dict) to on_message. """
+        if isinstance(payload, dict):
+            import json
+            payload = json.dumps(payload)
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        self.on_message(self, None, Message(topic or '', payload))
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""
+Benchmarks for polyinterface against an in-process stand-in for the PG3
+MQTT broker, using the loopback transport. Nothing is sent over the network.
+
+Measures import and startup time, config ingestion, driver update
+throughput, command dispatch latency and memory per node for a synthetic
+node server with --nodes nodes of --drivers drivers, and prints the
+results as JSON (or writes them to --output) so runs can be compared
+between releases.
+
+    python scripts/benchmark.py --nodes 1000 --drivers 10 --output bench.json
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeBroker(object):
+    """
+    Minimal PG3 stand-in behind a LoopbackTransport: counts publishes and
+    answers getAll and addnode.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.published = 0
+        self.bytes = 0
+        self.setItems = 0
+        self.autoReply = True
+
+    def received(self, topic, payload):
+        self.published += 1
+        self.bytes += len(payload)
+        if not self.autoReply:
+            return
+        message = json.loads(payload)
+        if 'set' in message and '/status/' in topic:
+            self.setItems += len(message['set'])
+        if 'getAll' in message:
+            self.reply({'getAll': []})
+        elif 'addnode' in message:
+            self.reply({'addnode': [{'address': n['address']} for n in message['addnode']]})
+
+    def reply(self, message):
+        # Replies arrive on the network thread in real life
+        threading.Thread(target=self.deliver, args=(message,)).start()
+
+    def deliver(self, message):
+        self.transport.deliver(json.dumps(message).encode('utf-8'))
+
+
+def synthetic_config(nodes, drivers):
+    return {
+        'nodes': [{
+            'address': 'n{}'.format(i) if i else 'controller',
+            'name': 'Node {}'.format(i),
+            'isPrimary': i == 0,
+            'primaryNode': 'controller',
+            'timeAdded': 0,
+            'enabled': True,
+            'drivers': [{'driver': 'GV{}'.format(d), 'value': '0', 'uom': 56}
+                        for d in range(drivers)],
+        } for i in range(nodes + 1)],
+        'logLevel': 'WARNING',
+        'customparams': {}, 'customdata': {},
+    }
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def bench_import():
+    """
+    Time a cold import in a fresh interpreter, and check it had no side
+    effects on the working directory or stdout and loaded no optional
+    modules.
+    """
+    code = ('import time, sys; s = time.perf_counter(); import polyinterface; '
+            'e = time.perf_counter() - s; '
+            'sys.__stdout__.write("{} {} {}".format(e, sys.stdout is sys.__stdout__, '
+            '",".join(m for m in ("markdown2", "netifaces", "paho", "ssl", "asyncio") '
+            'if m in sys.modules)))')
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    cwd = tempfile.mkdtemp()
+    out = subprocess.check_output([sys.executable, '-c', code], env=env, cwd=cwd)
+    fields = out.decode().strip().splitlines()[-1].split(' ')
+    return {
+        'seconds': float(fields[0]),
+        'stdout_redirected': fields[1] != 'True',
+        'created_files': sorted(os.listdir(cwd)),
+        'optional_modules_loaded': fields[2].split(',') if len(fields) > 2 else [],
+    }
+
+
+def run(args):
+    os.environ['PG3INIT'] = base64.b64encode(json.dumps({
+        'uuid': 'bench', 'profileNum': 1, 'token': 'x', 'secure': 1,
+        'mqttHost': 'localhost', 'mqttPort': 1883}).encode()).decode()
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, ROOT)
+    results = {'python': platform.python_version(), 'timestamp': time.time(),
+               'nodes': args.nodes, 'drivers': args.drivers}
+
+    imported = bench_import()
+    results['import_seconds'] = imported.pop('seconds')
+    results['import_side_effects'] = imported
+
+    import polyinterface
+    from polyinterface import polyinterface as pi
+    polyinterface.LOGGER.setLevel(args.log_level)
+    results['version'] = polyinterface.__version__
+
+    broker = FakeBroker()
+    broker.transport = polyinterface.LoopbackTransport(
+        onPublish=broker.received, maxPublished=0)
+
+    driverDefs = [{'driver': 'GV{}'.format(d), 'value': 0, 'uom': 56}
+                  for d in range(args.drivers)]
+    latencies = []
+    received = threading.Event()
+
+    class BenchNode(pi.Node):
+        id = 'bench'
+        drivers = driverDefs
+
+        def cmd_bench(self, command):
+            latencies.append(time.perf_counter() - float(command['sent']))
+            if len(latencies) >= args.commands:
+                received.set()
+
+        commands = {'BENCH': cmd_bench}
+
+    class CompactNode(BenchNode):
+        compactDrivers = True
+
+    class BenchController(pi.Controller):
+        DISPATCH_WORKERS = args.workers
+
+    # Startup: Interface + Controller construction and MQTT connect
+    started = time.perf_counter()
+    poly = pi.Interface('Bench', transport=broker.transport)
+    poly.start()
+    while not poly.connected:
+        time.sleep(0.001)
+    control = BenchController(poly)
+    results['startup_seconds'] = time.perf_counter() - started
+
+    # Config ingestion
+    config = synthetic_config(args.nodes, args.drivers)
+    started = time.perf_counter()
+    poly.inConfig(json.loads(json.dumps(config)))
+    results['config_ingest_seconds'] = time.perf_counter() - started
+
+    # Node construction
+    started = time.perf_counter()
+    nodes = [BenchNode(control, 'controller', 'n{}'.format(i + 1), 'Node')
+             for i in range(args.nodes)]
+    elapsed = time.perf_counter() - started
+    results['node_create_per_second'] = args.nodes / elapsed if elapsed else None
+
+    class CopiedNode(BenchNode):
+        # Instance level drivers are deep copied instead of stamped from
+        # the class template, for comparison
+        def __init__(self, *args):
+            self.drivers = driverDefs
+            BenchNode.__init__(self, *args)
+
+    started = time.perf_counter()
+    for i in range(args.nodes):
+        CopiedNode(control, 'controller', 'c{}'.format(i), 'Node')
+    elapsed = time.perf_counter() - started
+    results['node_create_deepcopy_per_second'] = args.nodes / elapsed if elapsed else None
+
+    broker.autoReply = False
+    started = time.perf_counter()
+    for node in nodes:
+        control.addNode(node)
+    elapsed = time.perf_counter() - started
+    results['add_node_per_second'] = args.nodes / elapsed if elapsed else None
+
+    # Config re-ingestion with the nodes added: an unchanged config, and
+    # one where every node changed for comparison
+    poly.inConfig(json.loads(json.dumps(config)))
+    unchanged = json.loads(json.dumps(config))
+    started = time.perf_counter()
+    poly.inConfig(unchanged)
+    results['config_reingest_seconds'] = time.perf_counter() - started
+    for node in config['nodes']:
+        node['drivers'][0]['value'] = '1'
+    changed = json.loads(json.dumps(config))
+    started = time.perf_counter()
+    poly.inConfig(changed)
+    results['config_reingest_changed_seconds'] = time.perf_counter() - started
+
+    bulk = [BenchNode(control, 'controller', 'b{}'.format(i), 'Node')
+            for i in range(args.nodes)]
+    published = broker.published
+    started = time.perf_counter()
+    control.addNodes(bulk)
+    elapsed = time.perf_counter() - started
+    results['add_nodes_bulk_per_second'] = args.nodes / elapsed if elapsed else None
+    results['add_nodes_bulk_messages'] = broker.published - published
+    for node in bulk:
+        del control.nodes[node.address]
+    control.nodesAdding.clear()
+    broker.autoReply = True
+
+    # Memory per node
+    for name, cls in (('memory_per_node_bytes', BenchNode),
+                      ('memory_per_compact_node_bytes', CompactNode)):
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        extra = [cls(control, 'controller', 'm{}'.format(i), 'Node')
+                 for i in range(args.nodes)]
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        size = sum(s.size_diff for s in after.compare_to(before, 'filename'))
+        results[name] = size / float(args.nodes)
+        del extra
+
+    # Driver update throughput
+    published = broker.published
+    updates = 0
+    started = time.perf_counter()
+    for rnd in range(args.rounds):
+        for node in nodes:
+            for d in driverDefs:
+                node.setDriver(d['driver'], rnd + 1)
+                updates += 1
+    poly.flush()
+    elapsed = time.perf_counter() - started
+    results['driver_updates_per_second'] = updates / elapsed if elapsed else None
+    results['publishes_per_driver_update'] = (broker.published - published) / float(updates)
+
+    # Command dispatch latency, from message arrival to the command function
+    for i in range(args.commands):
+        node = nodes[i % len(nodes)]
+        broker.deliver({'command': [{'address': node.address, 'command': 'BENCH',
+                                     'sent': repr(time.perf_counter())}]})
+    received.wait(60)
+    results['command_latency_seconds'] = {
+        'count': len(latencies),
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies) if latencies else None,
+    }
+    results['published_messages'] = broker.published
+    results['published_bytes'] = broker.bytes
+    poly.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=500)
+    parser.add_argument('--drivers', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='setDriver rounds over every node and driver')
+    parser.add_argument('--commands', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Controller.DISPATCH_WORKERS')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    results = run(args)
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    sys.__stdout__.write(data + '\n')
+
+
+if __name__ == '__main__':
+    main()
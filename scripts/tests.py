@@ -1,13 +1,1122 @@
+"""
+Tests for polyinterface. Interfaces talk to a LoopbackTransport, so no
+broker is needed. Logs are written to logs/ under PG3_TEST_DIR, a new
+temporary directory if it isn't set.
+
+    python scripts/tests.py
+"""
+
+import base64
+from copy import deepcopy
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('PG3INIT', base64.b64encode(json.dumps({
+    'uuid': 'test', 'profileNum': 1, 'token': 'x', 'secure': 1,
+    'mqttHost': 'localhost', 'mqttPort': 1883}).encode()).decode())
+os.chdir(os.environ.get('PG3_TEST_DIR') or tempfile.mkdtemp())
+
 import polyinterface
+from polyinterface import polycodec
+from polyinterface import polyinterface as pi
+from polyinterface import polylogger
+from polyinterface.polycache import FileCache
+from polyinterface.polydispatch import KeyedDispatcher
+from polyinterface.polydrivers import DriverSchema
+from polyinterface.polymetrics import MetricsRegistry
+from polyinterface.polyqueue import PriorityInputQueue
+from polyinterface.polyrequests import RequestError
+
+
+def waitFor(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class FlakyTransport(polyinterface.LoopbackTransport):
+    """ LoopbackTransport whose connects fail while up is False. """
+    up = True
+
+    def _connect(self):
+        if not self.up:
+            raise OSError('broker down')
+        polyinterface.LoopbackTransport._connect(self)
+
+
+class ShardNode(pi.Node):
+    """ Node run in a shard worker, it must be importable from there. """
+    id = 'shardnode'
+    drivers = [{'driver': 'ST', 'value': 0, 'uom': 56},
+               {'driver': 'GV0', 'value': 0, 'uom': 56}]
+
+    def start(self):
+        self.setDriver('GV0', os.getpid())
+
+    def shortPoll(self):
+        self.setDriver('ST', int(self.getDriver('ST') or 0) + 1)
+
+    def cmd_on(self, command):
+        self.setDriver('ST', 100)
+
+    commands = {'DON': cmd_on}
+
+
+class LoopbackTestCase(unittest.TestCase):
+    """
+    Starts an Interface, with the class attributes in settings, connected
+    to a LoopbackTransport. Published messages are kept in published as
+    (type, message).
+    """
+    interfaceClass = pi.Interface
+    transportClass = polyinterface.LoopbackTransport
+    settings = {}
+
+    def setUp(self):
+        # Only one Interface is allowed per process, start a new one anyway
+        pi.Interface._Interface__exists = False
+        self.published = []
+        self.transport = self.transportClass(onPublish=self._onPublish)
+        interfaceClass = type('TestInterface', (self.interfaceClass,), dict(self.settings))
+        self.poly = interfaceClass('Test', transport=self.transport)
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+        self.poly.start()
+        self.assertTrue(waitFor(lambda: self.poly.connected))
+        del self.published[:]
+
+    def tearDown(self):
+        self.poly.stop()
+
+    def _onPublish(self, topic, payload):
+        self.published.append((topic.split('/')[3], json.loads(payload)))
+
+    def sets(self, address=None):
+        """ (address, driver, value) of every driver value published. """
+        return [(item['address'], item['driver'], item['value'])
+                for type, message in list(self.published) if type == 'status'
+                for item in message.get('set', [])
+                if address is None or item['address'] == address]
+
 
 class TestPoly(unittest.TestCase):
 
     def test_poly(self):
+        pi.Interface._Interface__exists = False
         polyglot = polyinterface.Interface('Test')
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
         print(polyglot.network_interface)
         #polyglot.assertIsInstance(polyglot, polyinterface.Interface)
 
 
+class TestBatching(LoopbackTestCase):
+    settings = {'SEND_BATCH_WINDOW': 60}
+
+    def set(self, driver, value):
+        self.poly.send({'set': [{'address': 'n1', 'driver': driver, 'value': value, 'uom': 56}]}, 'status')
+
+    def test_latest_value_per_driver_in_one_message(self):
+        self.set('ST', '1')
+        self.set('GV0', '5')
+        self.set('ST', '2')
+        self.assertEqual(self.published, [])
+        self.poly.flush()
+        self.assertEqual(len(self.published), 1)
+        self.assertEqual(sorted(self.sets()), [('n1', 'GV0', '5'), ('n1', 'ST', '2')])
+
+    def test_other_messages_flush_first(self):
+        self.set('ST', '1')
+        self.poly.send({'addnode': []}, 'command')
+        self.assertEqual([type for type, _ in self.published], ['status', 'command'])
+
+    def test_flushed_after_window(self):
+        self.poly.SEND_BATCH_WINDOW = 0.05
+        self.set('ST', '1')
+        self.assertTrue(waitFor(lambda: self.sets() == [('n1', 'ST', '1')]))
+
+
+class TestDriverIndex(LoopbackTestCase):
+
+    class IndexNode(pi.Node):
+        drivers = [{'driver': 'ST', 'value': 0, 'uom': 56},
+                   {'driver': 'GV0', 'value': 0, 'uom': 56}]
+
+    def setUp(self):
+        LoopbackTestCase.setUp(self)
+        self.controller = pi.Controller(self.poly)
+        self.node = self.IndexNode(self.controller, 'controller', 'n1', 'Node')
+
+    def test_replaced_list(self):
+        self.node.setDriver('GV0', 1)
+        self.node.drivers = [{'driver': 'GV0', 'value': 0, 'uom': 56}]
+        self.node.setDriver('GV0', 2)
+        self.assertEqual(self.node.drivers[0]['value'], 2)
+        self.assertEqual(self.sets('n1'), [('n1', 'GV0', '1'), ('n1', 'GV0', '2')])
+
+    def test_list_edited_in_place(self):
+        self.node.setDriver('GV0', 1)
+        self.node.drivers.insert(0, {'driver': 'GV1', 'value': 0, 'uom': 56})
+        self.node.setDriver('GV0', 2)
+        self.node.setDriver('GV1', 3)
+        self.assertEqual([d['value'] for d in self.node.drivers], [3, 0, 2])
+
+    def test_reported_values_follow_update(self):
+        self.node.updateDrivers([{'driver': 'ST', 'value': 5, 'uom': 56}])
+        self.node.setDriver('ST', 5)
+        self.assertEqual(self.sets('n1'), [])
+        self.node.setDriver('ST', 6)
+        self.assertEqual(self.sets('n1'), [('n1', 'ST', '6')])
+
+
+class TestCompactDrivers(LoopbackTestCase):
+
+    class CompactNode(pi.Node):
+        compactDrivers = True
+        drivers = [{'driver': 'ST', 'value': 0, 'uom': 56},
+                   {'driver': 'GV0', 'value': 1, 'uom': 56, 'name': 'Level'}]
+
+    def setUp(self):
+        LoopbackTestCase.setUp(self)
+        self.controller = pi.Controller(self.poly)
+        self.node = self.CompactNode(self.controller, 'controller', 'n1', 'Node')
+
+    def test_looks_like_driver_list(self):
+        self.assertEqual(self.node.drivers, self.CompactNode.drivers)
+        self.assertEqual(self.node.drivers[1]['name'], 'Level')
+        self.assertEqual(dict(self.node.drivers[-1]),
+                         {'driver': 'GV0', 'value': 1, 'uom': 56, 'name': 'Level'})
+        copied = deepcopy(self.node.drivers)
+        self.assertEqual(type(copied), list)
+        self.assertEqual(type(copied[0]), dict)
+        self.assertRaises(KeyError, self.node.drivers[0].__setitem__, 'driver', 'GV1')
+
+    def test_set_and_report(self):
+        self.node.setDriver('ST', 0)
+        self.assertEqual(self.sets('n1'), [])
+        self.node.setDriver('ST', 7)
+        self.assertEqual(self.node.drivers[0]['value'], 7)
+        self.assertEqual(self.node._drivers[0]['value'], 7)
+        self.node.updateDrivers([{'driver': 'GV0', 'value': 4, 'uom': 56}])
+        self.node.setDriver('GV0', 4)
+        self.assertEqual(self.sets('n1'), [('n1', 'ST', '7')])
+        del self.published[:]
+        self.node.reportDrivers()
+        self.assertEqual(self.published[0][1]['set'][0],
+                         {'address': 'n1', 'driver': 'ST', 'value': 7, 'uom': 56})
+
+    def test_add_node_sends_plain_drivers(self):
+        self.poly.addNode(self.node)
+        entry = self.published[-1][1]['addnode'][0]
+        self.assertEqual(entry['drivers'][1],
+                         {'driver': 'GV0', 'value': 1, 'uom': 56, 'name': 'Level'})
+
+
+class TestLogQueue(unittest.TestCase):
+
+    class Capture(logging.Handler):
+        def __init__(self, gate=None):
+            logging.Handler.__init__(self)
+            self.records = []
+            self.gate = gate
+
+        def handle(self, record):
+            if self.gate is not None:
+                self.gate.wait(5)
+            self.records.append(record.getMessage())
+
+    def record(self, message):
+        return logging.LogRecord('test', logging.INFO, __file__, 0, message, None, None)
+
+    def test_drop_when_full(self):
+        handler = polylogger.PolyQueueHandler(queue.Queue(2), 'drop')
+        for i in range(5):
+            handler.emit(self.record(str(i)))
+        self.assertEqual((handler.queue.qsize(), handler.dropped), (2, 3))
+
+    def test_block_when_full(self):
+        handler = polylogger.PolyQueueHandler(queue.Queue(1), 'block')
+        handler.emit(self.record('0'))
+        thread = threading.Thread(target=handler.emit, args=(self.record('1'),))
+        thread.start()
+        time.sleep(0.05)
+        self.assertTrue(thread.is_alive())
+        handler.queue.get()
+        thread.join(5)
+        self.assertEqual((handler.queue.get_nowait().getMessage(), handler.dropped), ('1', 0))
+
+    def test_stop_with_full_queue_writes_everything(self):
+        gate = threading.Event()
+        capture = self.Capture(gate)
+        log_queue = queue.Queue(2)
+        listener = polylogger.PolyQueueListener(log_queue, capture)
+        listener.start()
+        for i in range(3):
+            log_queue.put(self.record(str(i)))
+        opener = threading.Timer(0.1, gate.set)
+        opener.start()
+        listener.stop()
+        self.assertEqual(capture.records, ['0', '1', '2'])
+
+
+class TestCodecs(unittest.TestCase):
+
+    def available(self):
+        codecs = []
+        for name in polycodec.AUTO_ORDER:
+            try:
+                codecs.append(polycodec.CODECS[name]())
+            except ImportError:
+                pass
+        return codecs
+
+    def test_selection(self):
+        self.assertEqual(polycodec.getCodec('json').name, 'json')
+        self.assertEqual(polycodec.getCodec('unknown').name, 'json')
+        self.assertEqual(polycodec.getCodec().name, self.available()[0].name)
+
+    def test_decodes_bytes_and_str(self):
+        message = {'set': [{'address': 'n1', 'driver': 'ST', 'value': '1'}]}
+        for codec in self.available():
+            encoded = codec.dumps(message)
+            if not isinstance(encoded, bytes):
+                encoded = encoded.encode('utf-8')
+            self.assertEqual(codec.loads(encoded), message, codec.name)
+            self.assertEqual(codec.loads(encoded.decode('utf-8')), message, codec.name)
+
+    def test_falls_back_to_json_encoding(self):
+        for codec in self.available():
+            encoded = codec.dumps({1: 2 ** 70})
+            if isinstance(encoded, bytes):
+                encoded = encoded.decode('utf-8')
+            self.assertEqual(json.loads(encoded), {'1': 2 ** 70}, codec.name)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        registry = MetricsRegistry()
+        registry.counter('sent_total', 'Messages sent', type='status').inc(3)
+        registry.gauge('depth', fn=lambda: 7)
+        histogram = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+        self.assertEqual(registry.render(), '\n'.join([
+            '# TYPE depth gauge',
+            'depth 7',
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            'latency_seconds_sum 5.55',
+            'latency_seconds_count 3',
+            '# HELP sent_total Messages sent',
+            '# TYPE sent_total counter',
+            'sent_total{type="status"} 3',
+        ]) + '\n')
+
+    def test_same_metric_returned(self):
+        registry = MetricsRegistry()
+        self.assertIs(registry.counter('c', kind='a'), registry.counter('c', kind='a'))
+        self.assertIsNot(registry.counter('c', kind='a'), registry.counter('c', kind='b'))
+        self.assertRaises(ValueError, registry.gauge, 'c')
+
+    def test_label_values_escaped(self):
+        registry = MetricsRegistry()
+        registry.counter('c', node='a"b\\c').inc()
+        self.assertIn('c{node="a\\"b\\\\c"} 1', registry.render())
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_small_run(self):
+        output = os.path.join(tempfile.mkdtemp(), 'bench.json')
+        subprocess.check_call([sys.executable, os.path.join(ROOT, 'scripts', 'benchmark.py'),
+                               '--nodes', '5', '--drivers', '2', '--rounds', '1',
+                               '--commands', '5', '--output', output],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(output) as f:
+            results = json.load(f)
+        self.assertEqual(results['command_latency_seconds']['count'], 5)
+        for key in ('startup_seconds', 'config_ingest_seconds', 'config_reingest_seconds',
+                    'node_create_per_second', 'driver_updates_per_second',
+                    'memory_per_node_bytes'):
+            self.assertIsNotNone(results[key], key)
+
+
+class TestImport(unittest.TestCase):
+
+    def importIn(self, code):
+        cwd = tempfile.mkdtemp()
+        out = subprocess.check_output(
+            [sys.executable, '-c', 'import sys; import polyinterface; ' + code],
+            env=dict(os.environ, PYTHONPATH=ROOT), cwd=cwd)
+        return out.decode().strip().splitlines()[-1], os.listdir(cwd)
+
+    def test_no_side_effects(self):
+        out, created = self.importIn(
+            'sys.__stdout__.write(repr((sys.stdout is sys.__stdout__, sorted(m for m in '
+            '("markdown2", "netifaces", "ssl", "asyncio") if m in sys.modules))))')
+        self.assertEqual(out, repr((True, [])))
+        self.assertEqual(created, [])
+
+    def test_async_classes_loaded_on_use(self):
+        out, _ = self.importIn(
+            'polyinterface.AsyncController; print("asyncio" in sys.modules)')
+        self.assertEqual(out, 'True')
+
+
+class TestFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = FileCache()
+        self.path = os.path.join(tempfile.mkdtemp(), 'server.json')
+        self.write('{"a": 1}')
+        self.loads = []
+
+    def write(self, data, mtime=1000000000):
+        with open(self.path, 'w') as f:
+            f.write(data)
+        os.utime(self.path, (mtime, mtime))
+
+    def load(self, path):
+        with open(path) as f:
+            self.loads.append(path)
+            return json.load(f)
+
+    def test_cached_until_changed(self):
+        first = self.cache.get(self.path, self.load)
+        self.assertIs(self.cache.get(self.path, self.load), first)
+        self.assertEqual(self.cache.stats, {'hits': 1, 'loads': 1})
+        # Same mtime, different size
+        self.write('{"a": 22}')
+        self.assertEqual(self.cache.get(self.path, self.load), {'a': 22})
+        # Same size, different mtime
+        self.write('{"a": 33}', 1000000001)
+        self.assertEqual(self.cache.get(self.path, self.load), {'a': 33})
+        self.assertEqual(len(self.loads), 3)
+
+    def test_loader_is_part_of_key(self):
+        self.cache.get(self.path, self.load)
+        self.assertEqual(self.cache.get(self.path, lambda path: 'other'), 'other')
+        self.cache.clear()
+        self.cache.get(self.path, self.load)
+        self.assertEqual(len(self.loads), 2)
+
+
+class TestTransport(LoopbackTestCase):
+
+    def test_transport_is_abstract(self):
+        self.assertRaises(TypeError, polyinterface.Transport)
+
+    def test_connect_subscribes_and_requests_custom_data(self):
+        self.assertIn(self.poly.topicInput, self.transport.subscriptions)
+        self.assertEqual(self.transport.published[0][0], 'udi/pg3/ns/custom/test_1')
+        self.assertIn('getAll', json.loads(self.transport.published[0][1]))
+
+    def test_publish_and_deliver(self):
+        self.poly.send({'command': [{'address': 'n1', 'command': 'DON'}]}, 'command')
+        self.assertEqual(self.published, [('command', {'command': [{'address': 'n1', 'command': 'DON'}]})])
+        self.transport.deliver({'query': {'address': 'all'}})
+        self.assertTrue(waitFor(lambda: self.poly.inQueue.qsize() == 1))
+        self.assertEqual(self.poly.inQueue.get(), {'query': {'address': 'all'}})
+
+    def test_publish_while_dropped_is_not_sent(self):
+        self.transport.drop()
+        self.assertEqual(self.transport.publish('t', '{}').rc, polyinterface.polytransport.MQTT_ERR_NO_CONN)
+
+
+class TestReconnect(LoopbackTestCase):
+    transportClass = FlakyTransport
+    settings = {'RECONNECT_INITIAL_DELAY': 0.01, 'RECONNECT_MAX_DELAY': 0.01}
+
+    def test_one_reconnect_per_drop(self):
+        connects = []
+        self.transport.on_connect = lambda *args: (connects.append(1), self.poly._connect(*args))
+        self.transport.drop()
+        self.assertTrue(waitFor(lambda: self.poly.connected))
+        time.sleep(0.2)
+        self.assertEqual(len(connects), 1)
+        self.assertEqual(self.poly.reconnectStats['reconnects'], 1)
+
+    def test_gives_up_after_max_attempts(self):
+        attempts = []
+        connect = self.transport._connect
+        self.transport._connect = lambda: (attempts.append(1), connect())
+        self.poly.reconnectPolicy.maxAttempts = 3
+        self.transport.up = False
+        self.transport.drop()
+        self.assertTrue(waitFor(lambda: not self.poly._threads['socket'].is_alive()))
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(self.poly.reconnectStats['attempts'], 2)
+        self.assertEqual(self.poly._connectFailures, 3)
+        self.assertFalse(self.poly.connected)
+
+    def test_backoff_delays(self):
+        policy = pi.ReconnectPolicy(1, 10, 2, None)
+        for attempt in range(8):
+            self.assertLessEqual(policy.delay(attempt), min(10, 2 ** attempt))
+        self.assertTrue(policy.shouldRetry(1000))
+        self.assertFalse(pi.ReconnectPolicy(maxAttempts=2).shouldRetry(2))
+
+
+class TestOfflineReplay(LoopbackTestCase):
+    transportClass = FlakyTransport
+    settings = {'RECONNECT_INITIAL_DELAY': 0.05, 'RECONNECT_MAX_DELAY': 0.05}
+
+    def set(self, value):
+        self.poly.send({'set': [{'address': 'n1', 'driver': 'ST', 'value': value, 'uom': 56}]}, 'status')
+
+    def disconnect(self):
+        self.transport.up = False
+        self.transport.drop()
+        self.assertFalse(self.poly.connected)
+
+    def test_replay_after_reconnect(self):
+        self.disconnect()
+        for value in ('1', '2', '3'):
+            self.set(value)
+        self.poly.send({'command': [{'address': 'n1', 'command': 'DON'}]}, 'command')
+        self.assertEqual(self.published, [])
+        self.assertEqual(self.poly.offlineBufferStats()['drivers'], 1)
+        self.transport.up = True
+        self.assertTrue(waitFor(lambda: self.poly.connected))
+        types = [type for type, _ in self.published if type != 'custom']
+        self.assertEqual(types, ['command', 'status'])
+        self.assertEqual(self.sets(), [('n1', 'ST', '3')])
+        self.assertEqual(self.poly.reconnectStats['reconnects'], 1)
+
+    def test_send_while_connecting_is_not_overtaken_by_replay(self):
+        self.disconnect()
+        self.set('1')
+        subscribe = self.transport.subscribe
+
+        def sendWhileSubscribing(topic, qos=0):
+            self.set('2')
+            return subscribe(topic, qos)
+
+        self.transport.subscribe = sendWhileSubscribing
+        self.transport.up = True
+        self.assertTrue(waitFor(lambda: self.poly.connected))
+        self.assertEqual(self.sets(), [('n1', 'ST', '2')])
+
+
+class TestAsyncController(LoopbackTestCase):
+    interfaceClass = polyinterface.AsyncInterface
+
+    def setUp(self):
+        LoopbackTestCase.setUp(self)
+        import asyncio
+        self.order = []
+        order = self.order
+
+        class AsyncNode(pi.Node):
+            drivers = [{'driver': 'ST', 'value': 0, 'uom': 56}]
+
+            async def cmd_slow(self, command):
+                await asyncio.sleep(command['delay'])
+                order.append((self.address, command['seq']))
+                self.setDriver('ST', command['seq'])
+
+            def cmd_sync(self, command):
+                order.append((self.address, command['seq']))
+
+            commands = {'SLOW': cmd_slow, 'SYNC': cmd_sync}
+
+        self.controller = polyinterface.AsyncController(self.poly)
+        for address in ('n1', 'n2'):
+            self.controller.nodes[address] = AsyncNode(self.controller, 'controller', address, 'Node')
+        thread = threading.Thread(target=self.controller.runForever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.controller.loop.call_soon_threadsafe(self.controller.loop.stop)
+        LoopbackTestCase.tearDown(self)
+
+    def command(self, address, command, seq, delay=0):
+        self.transport.deliver({'command': [{'address': address, 'command': command,
+                                             'seq': seq, 'delay': delay}]})
+
+    def test_order_per_node(self):
+        self.command('n1', 'SLOW', 1, 0.2)
+        self.command('n1', 'SYNC', 2)
+        self.command('n2', 'SLOW', 3, 0.05)
+        self.assertTrue(waitFor(lambda: len(self.order) == 3))
+        self.assertEqual(self.order, [('n2', 3), ('n1', 1), ('n1', 2)])
+
+    def test_set_driver_from_coroutine(self):
+        self.command('n1', 'SLOW', 5)
+        self.assertTrue(waitFor(lambda: self.sets('n1') == [('n1', 'ST', '5')]))
+
+
+class TestCustomSaves(LoopbackTestCase):
+    settings = {'CUSTOM_SAVE_DELAY': 0.1}
+
+    def saved(self):
+        return [message['set'][0] for type, message in self.published if type == 'custom']
+
+    def test_debounced(self):
+        for value in range(3):
+            self.poly.custom['data'] = {'value': value}
+            self.poly.saveCustom('data')
+        self.assertEqual(self.saved(), [])
+        self.assertTrue(waitFor(lambda: self.saved()))
+        time.sleep(0.15)
+        self.assertEqual(self.saved(), [{'key': 'data', 'value': {'value': 2}}])
+
+    def test_unchanged_not_sent(self):
+        self.poly.custom['data'] = {'value': 1}
+        self.poly.saveCustom('data')
+        self.poly.flushCustom()
+        future = self.poly.saveCustom('data')
+        self.poly.flushCustom()
+        self.assertEqual(len(self.saved()), 1)
+        self.assertIsNone(future.result(0))
+
+    def test_failed_send_kept_for_next_flush(self):
+        send = self.poly.send
+        failures = []
+
+        def failOnce(message, type='status'):
+            if type == 'custom' and not failures:
+                failures.append(message)
+                raise OSError('send failed')
+            return send(message, type)
+
+        self.poly.send = failOnce
+        self.poly.custom['data'] = {'value': 1}
+        self.poly.saveCustom('data')
+        self.poly.flushCustom()
+        self.assertEqual((len(failures), self.saved()), (1, []))
+        self.assertTrue(waitFor(lambda: self.saved() == [{'key': 'data', 'value': {'value': 1}}]))
+
+
+class TestKeyedDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = KeyedDispatcher(4)
+
+    def tearDown(self):
+        self.dispatcher.stop()
+
+    def test_order_per_key(self):
+        done = []
+        for seq in range(20):
+            for key in ('a', 'b'):
+                self.dispatcher.submit(key, lambda key, seq: (time.sleep(0.001), done.append((key, seq))), key, seq)
+        self.assertTrue(waitFor(lambda: len(done) == 40))
+        for key in ('a', 'b'):
+            self.assertEqual([seq for k, seq in done if k == key], list(range(20)))
+
+    def test_keys_run_concurrently(self):
+        done = []
+        started = time.time()
+        for key in ('a', 'b', 'c'):
+            self.dispatcher.submit(key, lambda: (time.sleep(0.2), done.append(1)))
+        self.assertTrue(waitFor(lambda: len(done) == 3))
+        self.assertLess(time.time() - started, 0.35)
+
+    def test_failed_job_does_not_block_key(self):
+        done = []
+        self.dispatcher.submit('a', lambda: 1 / 0)
+        self.dispatcher.submit('a', lambda: done.append(1))
+        self.assertTrue(waitFor(lambda: done))
+        stats = self.dispatcher.stats()
+        self.assertEqual((stats['failed'], stats['completed']), (1, 1))
+
+
+class TestPolls(LoopbackTestCase):
+
+    def test_queued_polls_coalesced(self):
+        for _ in range(3):
+            self.poly.input({'shortPoll': {}})
+        self.poly.input({'longPoll': {}})
+        self.assertEqual(self.poly.inQueue.qsize(), 2)
+        self.assertEqual(self.poly.pollsCoalesced['shortPoll'], 2)
+        self.poly._pollStarted('shortPoll')
+        self.poly.input({'shortPoll': {}})
+        self.assertEqual(self.poly.inQueue.qsize(), 3)
+
+    def test_local_polls_skip_overruns_and_stop_with_interface(self):
+        runs = []
+        controller = pi.Controller(self.poly)
+        controller.addPoll('slow', lambda: (runs.append(time.time()), time.sleep(0.25)), 0.1, offset=0)
+        self.assertTrue(waitFor(lambda: len(runs) >= 2))
+        self.assertGreater(controller.pollStats()['slow']['skipped'], 0)
+        self.poly.stop()
+        time.sleep(0.3)
+        count = len(runs)
+        time.sleep(0.4)
+        self.assertEqual(len(runs), count)
+        self.assertFalse(controller.poller._dispatcher._threads[0].is_alive())
+
+
+class TestAsyncPolls(LoopbackTestCase):
+    interfaceClass = polyinterface.AsyncInterface
+
+    def test_polls_coalesced_on_the_loop(self):
+        import asyncio
+        runs = []
+
+        class TestController(polyinterface.AsyncController):
+            async def shortPoll(self):
+                runs.append(time.time())
+                await asyncio.sleep(0.2)
+
+        controller = TestController(self.poly)
+        for _ in range(10):
+            self.poly.input({'shortPoll': {}})
+        thread = threading.Thread(target=controller.runForever)
+        thread.daemon = True
+        thread.start()
+        self.assertTrue(waitFor(lambda: runs))
+        time.sleep(0.4)
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(self.poly.pollsCoalesced['shortPoll'], 9)
+        controller.loop.call_soon_threadsafe(controller.loop.stop)
+
+
+class TestReportPolicies(LoopbackTestCase):
+
+    class PolicyNode(pi.Node):
+        drivers = [{'driver': 'ST', 'value': 0, 'uom': 17},
+                   {'driver': 'GV0', 'value': 0, 'uom': 56},
+                   {'driver': 'GV1', 'value': 0, 'uom': 56}]
+        reportPolicies = {
+            'ST': {'deadband': 1},
+            'GV0': {'minInterval': 0.2},
+            'GV1': {'maxInterval': 0.1},
+        }
+
+    def setUp(self):
+        LoopbackTestCase.setUp(self)
+        self.controller = pi.Controller(self.poly)
+        self.node = self.PolicyNode(self.controller, 'controller', 'n1', 'Policy')
+
+    def test_deadband(self):
+        for value in (10, 10.5, 11, 12):
+            self.node.setDriver('ST', value)
+        self.assertEqual(self.sets('n1'), [('n1', 'ST', '10'), ('n1', 'ST', '12')])
+
+    def test_min_interval_reports_latest_value(self):
+        for value in (1, 2, 3):
+            self.node.setDriver('GV0', value)
+        self.assertEqual(self.sets('n1'), [('n1', 'GV0', '1')])
+        self.assertTrue(waitFor(lambda: len(self.sets('n1')) == 2))
+        self.assertEqual(self.sets('n1')[-1], ('n1', 'GV0', '3'))
+
+    def test_force(self):
+        self.node.setDriver('ST', 10)
+        self.node.setDriver('ST', 10.2, force=True)
+        self.assertEqual(len(self.sets('n1')), 2)
+
+    def test_max_interval_reports_unchanged_value(self):
+        self.node.setDriver('GV1', 1)
+        self.node.setDriver('GV1', 1)
+        self.assertEqual(len(self.sets('n1')), 1)
+        time.sleep(0.15)
+        self.node.setDriver('GV1', 1)
+        self.assertEqual(self.sets('n1'), [('n1', 'GV1', '1')] * 2)
+
+
+class TestConfigIndex(LoopbackTestCase):
+
+    config = {'nodes': [{'address': 'n1', 'name': 'Node 1', 'isPrimary': False,
+                         'primaryNode': 'controller', 'timeAdded': 0, 'enabled': True,
+                         'drivers': [{'driver': 'ST', 'value': '1', 'uom': 56},
+                                     {'driver': 'GV0', 'value': '2', 'uom': 56}]}]}
+
+    def test_lookups(self):
+        self.assertFalse(self.poly.getNode('n1'))
+        self.poly.inConfig(deepcopy(self.config))
+        self.assertEqual(self.poly.getNode('n1')['name'], 'Node 1')
+        self.assertFalse(self.poly.getNode('n2'))
+        self.assertEqual(self.poly.getDriver('n1', 'GV0'), '2')
+        self.assertIsNone(self.poly.getDriver('n1', 'GV9'))
+
+    def test_set_result_updates_driver(self):
+        self.poly.inConfig(deepcopy(self.config))
+        self.transport.deliver({'set': [{'address': 'n1', 'driver': 'ST', 'value': '5', 'uom': 51}]})
+        self.assertTrue(self.poly.waitReceived(5))
+        self.assertEqual(self.poly.getDriver('n1', 'ST'), '5')
+        self.assertEqual(self.poly.getNode('n1')['drivers'][0]['uom'], 51)
+
+
+class TestConfigIngest(LoopbackTestCase):
+
+    def config(self, values):
+        return {'nodes': [{'address': address, 'name': address, 'isPrimary': False,
+                           'primaryNode': 'controller', 'timeAdded': 0, 'enabled': True,
+                           'drivers': [{'driver': 'ST', 'value': value, 'uom': 56}]}
+                          for address, value in sorted(values.items())],
+                'logLevel': 'WARNING'}
+
+    def test_unchanged_nodes_kept(self):
+        self.poly.inConfig(self.config({'n1': 0, 'n2': 0}))
+        first = self.poly.getNode('n1')
+        self.poly.inConfig(self.config({'n1': 0, 'n2': 5}))
+        self.assertIs(self.poly.getNode('n1'), first)
+        self.assertIs(self.poly.config['nodes'][0], first)
+        self.assertEqual(self.poly.getDriver('n2', 'ST'), 5)
+        self.poly.inConfig(self.config({'n1': 0}))
+        self.assertFalse(self.poly.getNode('n2'))
+        self.assertIsNone(self.poly.getDriver('n2', 'ST'))
+        self.assertEqual(self.poly.configStats, {'received': 3, 'changed': 3, 'removed': 1})
+
+    def test_controller_skips_unchanged_nodes(self):
+        updated = []
+        controller = pi.Controller(self.poly)
+        node = pi.Node(controller, 'controller', 'n1', 'Node 1')
+        node.drivers = [{'driver': 'ST', 'value': 0, 'uom': 56}]
+        node.updateDrivers = updated.append
+        controller.nodes['n1'] = node
+        self.poly.inConfig(self.config({'controller': 0, 'n1': 0}))
+        self.poly.inConfig(self.config({'controller': 0, 'n1': 0}))
+        self.assertEqual(len(updated), 1)
+        self.poly.inConfig(self.config({'controller': 0, 'n1': 1}))
+        self.assertEqual(len(updated), 2)
+
+    def test_ingested_in_order_on_receive_thread(self):
+        threads = []
+
+        def observer(config):
+            time.sleep(0.2)
+            threads.append(threading.current_thread().name)
+
+        self.poly.onConfig(observer)
+        self.transport.deliver({'config': self.config({'n1': 0})})
+        self.transport.deliver({'set': [{'address': 'n1', 'driver': 'ST', 'value': 3}]})
+        self.assertTrue(self.poly.waitReceived(5))
+        self.assertEqual(threads, ['Receive'])
+        self.assertEqual(self.poly.getDriver('n1', 'ST'), 3)
+
+
+class TestReceive(LoopbackTestCase):
+
+    def test_concurrent_delivery_keeps_order(self):
+        def sender(address):
+            for seq in range(50):
+                self.transport.deliver({'command': {'address': address, 'seq': seq}})
+
+        senders = [threading.Thread(target=sender, args=('n{}'.format(i),))
+                   for i in range(8)]
+        for thread in senders:
+            thread.start()
+        for thread in senders:
+            thread.join()
+        self.assertTrue(self.poly.waitReceived(5))
+        received = {}
+        while not self.poly.inQueue.empty():
+            command = self.poly.inQueue.get()['command']
+            received.setdefault(command['address'], []).append(command['seq'])
+        self.assertEqual(len(received), 8)
+        for seqs in received.values():
+            self.assertEqual(seqs, list(range(50)))
+        self.assertEqual(self.poly.receiveStats['processed'], 400)
+
+    def test_received_before_start_is_routed(self):
+        pi.Interface._Interface__exists = False
+        transport = polyinterface.LoopbackTransport()
+        poly = pi.Interface('Test', transport=transport)
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+        transport.deliver({'query': {}})
+        poly.start()
+        try:
+            self.assertTrue(poly.waitReceived(5))
+            self.assertEqual(poly.inQueue.get_nowait(), {'query': {}})
+        finally:
+            poly.stop()
+
+
+class TestPriorityLanes(LoopbackTestCase):
+    settings = {'INPUT_LANE_WEIGHTS': {}}
+
+    def test_opt_in(self):
+        self.assertIsNone(pi.Interface.INPUT_LANE_WEIGHTS)
+        self.assertIsInstance(self.poly.inQueue, PriorityInputQueue)
+
+    def test_weighted_order(self):
+        queue = PriorityInputQueue({'command': 3, 'poll': 1})
+        for _ in range(4):
+            queue.put({'shortPoll': {}})
+        for _ in range(6):
+            queue.put({'command': {}})
+        order = []
+        while not queue.empty():
+            order.append(list(queue.get_nowait())[0][0])
+            queue.task_done()
+        self.assertEqual(''.join(order), 'cccsccc' + 'sss')
+
+    def test_promoted_after_max_wait(self):
+        queue = PriorityInputQueue(maxWait=0.05)
+        queue.put({'longPoll': {}})
+        time.sleep(0.06)
+        queue.put({'command': {}})
+        self.assertIn('longPoll', queue.get())
+        self.assertEqual(queue.stats()['promoted'], 1)
+
+    def dispatchController(self, workers, order, delay):
+        class SlowNode(pi.Node):
+            def query(self):
+                order.append(('q', self.address))
+                time.sleep(delay)
+
+            def cmd_x(self, command):
+                order.append(('c', self.address))
+                time.sleep(delay)
+
+            commands = {'X': cmd_x}
+
+        class TestController(pi.Controller):
+            DISPATCH_WORKERS = workers
+
+        controller = TestController(self.poly)
+        for i in range(10):
+            address = 'n{}'.format(i)
+            controller.nodes[address] = SlowNode(controller, 'controller', address, 'Slow')
+        return controller
+
+    def test_command_passes_queries_with_dispatch_pool(self):
+        order = []
+        self.dispatchController(1, order, 0.05)
+        for i in range(10):
+            self.poly.inQueue.put({'query': {'address': 'n{}'.format(i)}})
+        time.sleep(0.02)
+        self.poly.inQueue.put({'command': {'address': 'n0', 'command': 'X'}})
+        self.assertTrue(waitFor(lambda: len(order) == 11))
+        self.assertLess(order.index(('c', 'n0')), 5)
+
+    def test_slow_node_does_not_hold_idle_workers(self):
+        order = []
+        self.dispatchController(4, order, 0.5)
+        for _ in range(4):
+            self.poly.inQueue.put({'command': {'address': 'n0', 'command': 'X'}})
+        time.sleep(0.05)
+        started = time.time()
+        self.poly.inQueue.put({'command': {'address': 'n1', 'command': 'X'}})
+        self.assertTrue(waitFor(lambda: ('c', 'n1') in order))
+        self.assertLess(time.time() - started, 0.3)
+
+
+class TestAddNodes(LoopbackTestCase):
+
+    def setUp(self):
+        LoopbackTestCase.setUp(self)
+        self.started = []
+
+        class SlowStartNode(pi.Node):
+            def start(node):
+                time.sleep(0.2)
+                self.started.append(node.address)
+
+        self.controller = pi.Controller(self.poly)
+        self.nodes = [SlowStartNode(self.controller, 'controller', 'n{}'.format(i), 'Node')
+                      for i in range(5)]
+
+    def test_chunked(self):
+        added = self.controller.addNodes(self.nodes, chunk=2)
+        self.assertEqual(list(added), ['n0', 'n1', 'n2', 'n3', 'n4'])
+        batches = [[entry['address'] for entry in message['addnode']]
+                   for type, message in self.published if type == 'command']
+        self.assertEqual(batches, [['n0', 'n1'], ['n2', 'n3'], ['n4']])
+        self.assertEqual(set(self.controller.nodesAdding), set(added))
+
+    def test_wait_for_nodes_waits_for_start(self):
+        added = self.controller.addNodes(self.nodes)
+        self.transport.deliver({'addnode': [{'address': node.address} for node in self.nodes]})
+        # Called while the first node's start() runs
+        time.sleep(0.1)
+        self.assertEqual(self.controller.waitForNodes(['n0'], timeout=5), set())
+        self.assertIn('n0', self.started)
+        self.assertEqual(self.controller.waitForNodes(timeout=5), set())
+        self.assertEqual(sorted(self.started), sorted(added))
+        self.assertEqual(added['n0'].result(0), {'address': 'n0'})
+        self.assertEqual(self.controller.nodesAdding, {})
+
+    def test_wait_for_nodes_timeout(self):
+        self.controller.addNodes(self.nodes)
+        self.transport.deliver({'addnode': [{'address': 'n0'}]})
+        self.assertEqual(self.controller.waitForNodes(['n0', 'n1'], timeout=0.5), {'n1'})
+        self.assertEqual(self.started, ['n0'])
+
+
+class TestAsyncAddNodes(LoopbackTestCase):
+    interfaceClass = polyinterface.AsyncInterface
+
+    def test_wait_for_nodes_waits_for_async_start(self):
+        import asyncio
+        started = []
+
+        class AsyncNode(pi.Node):
+            async def start(self):
+                await asyncio.sleep(0.2)
+                started.append(self.address)
+
+        controller = polyinterface.AsyncController(self.poly)
+        thread = threading.Thread(target=controller.runForever)
+        thread.daemon = True
+        thread.start()
+        controller.addNode(AsyncNode(controller, 'controller', 'n1', 'Node'))
+        self.transport.deliver({'addnode': [{'address': 'n1'}]})
+        self.assertEqual(controller.waitForNodes(timeout=5), set())
+        self.assertEqual(started, ['n1'])
+        controller.loop.call_soon_threadsafe(controller.loop.stop)
+
+
+class TestRequests(LoopbackTestCase):
+
+    def test_add_node_resolved_by_result(self):
+        node = pi.Node(None, 'controller', 'n1', 'Node')
+        future = self.poly.addNode(node)
+        self.assertFalse(future.done())
+        self.transport.deliver({'addnode': [{'address': 'n1'}]})
+        self.assertEqual(future.result(2), {'address': 'n1'})
+
+    def test_single_add_node_result(self):
+        future = self.poly.addNode(pi.Node(None, 'controller', 'n2', 'Node'))
+        self.transport.deliver({'addnode': {'address': 'n2'}})
+        self.assertEqual(future.result(2)['address'], 'n2')
+        # and still reaches the Controller
+        self.assertTrue(waitFor(lambda: self.poly.inQueue.qsize() == 1))
+
+    def test_custom_saved_and_rejected(self):
+        self.poly.custom['good'] = {'a': 1}
+        self.poly.custom['bad'] = {'b': 2}
+        good = self.poly.saveCustom('good')
+        bad = self.poly.saveCustom('bad')
+        self.transport.deliver({'set': [{'good': {}, 'success': True},
+                                        {'bad': {}, 'success': False, 'error': 'db'}]})
+        self.assertTrue(good.result(2)['success'])
+        self.assertRaises(RequestError, bad.result, 2)
+        # A rejected value is sent again by the next save
+        del self.published[:]
+        self.poly.saveCustom('bad')
+        self.assertEqual(self.published[-1][1], {'set': [{'key': 'bad', 'value': {'b': 2}}]})
+
+    def test_unanswered_request_times_out(self):
+        self.poly.requests.timeout = 0.05
+        future = self.poly.delNode('gone')
+        self.assertRaises(polyinterface.polyinterface.futures.TimeoutError, future.result, 2)
+
+    def test_controller_add_chained_from_acknowledgement(self):
+        controller = pi.Controller(self.poly)
+        self.poly.requests.timeout = 0.05
+        controller.addNode(pi.Node(controller, 'controller', 'n3', 'Node'))
+        self.assertEqual(self.poly.requests.pending(), 1)
+        added = controller.nodesAdding['n3']
+        self.assertRaises(polyinterface.polyinterface.futures.TimeoutError, added.result, 2)
+        self.assertEqual(controller.nodesAdding, {})
+        self.assertEqual(controller.waitForNodes(timeout=0), set())
+
+
+class TestDriverTemplates(unittest.TestCase):
+
+    class TemplateNode(pi.Node):
+        drivers = [{'driver': 'ST', 'value': 0, 'uom': 56},
+                   {'driver': 'GV0', 'value': 1, 'uom': 56}]
+
+    def test_stamped_nodes_do_not_share_drivers(self):
+        first = self.TemplateNode(None, 'controller', 'n1', 'Node')
+        second = self.TemplateNode(None, 'controller', 'n2', 'Node')
+        first.drivers[0]['value'] = 5
+        self.assertEqual(second.drivers[0]['value'], 0)
+        self.assertEqual(self.TemplateNode.drivers[0]['value'], 0)
+        self.assertIsNot(first.drivers[1], self.TemplateNode.drivers[1])
+
+    def test_nested_values_are_deep_copied(self):
+        schema = DriverSchema([{'driver': 'GV0', 'value': [1], 'uom': 56}])
+        self.assertFalse(schema.shallow)
+        stamped = schema.stamp()
+        stamped[0]['value'].append(2)
+        self.assertEqual(schema.source[0]['value'], [1])
+
+    def test_schema_follows_replaced_class_drivers(self):
+        class Node(pi.Node):
+            drivers = [{'driver': 'ST', 'value': 0, 'uom': 56}]
+
+        schema = DriverSchema.forClass(Node)
+        self.assertTrue(schema.shallow)
+        self.assertIs(DriverSchema.forClass(Node), schema)
+        Node.drivers = [{'driver': 'GV1', 'value': 0, 'uom': 56}]
+        self.assertEqual(DriverSchema.forClass(Node).codes, ('GV1',))
+
+
+class TestShardForwarding(LoopbackTestCase):
+
+    class Controller(polyinterface.ShardedController):
+        SHARDS = 2
+        SHARD_LOG_FILES = False
+
+    def setUp(self):
+        LoopbackTestCase.setUp(self)
+        self.controller = self.Controller(self.poly)
+        self.nodes = self.controller.createNodes(
+            [(ShardNode, 'controller', 'n{}'.format(i), 'Shard') for i in range(4)])
+        self.controller.addNodes(self.nodes)
+        self.transport.deliver({'addnode': [{'address': node.address} for node in self.nodes]})
+        self.assertTrue(waitFor(lambda: len(self.sets()) >= 4, 20))
+
+    def test_nodes_run_in_workers(self):
+        pids = set(int(value) for _, driver, value in self.sets() if driver == 'GV0')
+        self.assertEqual(len(pids), len(set(node.shard for node in self.nodes)))
+        self.assertNotIn(os.getpid(), pids)
+
+    def test_command_forwarded_and_value_kept(self):
+        node = self.nodes[0]
+        self.transport.deliver({'command': [{'address': node.address, 'command': 'DON'}]})
+        self.assertTrue(waitFor(lambda: (node.address, 'ST', '100') in self.sets()))
+        self.assertTrue(waitFor(lambda: node.drivers[0]['value'] == 100))
+
+    def test_config_does_not_overwrite_worker_values(self):
+        node = self.nodes[0]
+        self.transport.deliver({'command': [{'address': node.address, 'command': 'DON'}]})
+        self.assertTrue(waitFor(lambda: (node.address, 'ST', '100') in self.sets()))
+        node.updateDrivers([{'driver': 'ST', 'value': 100, 'uom': 56},
+                            {'driver': 'GV0', 'value': 0, 'uom': 56}])
+        del self.published[:]
+        node.reportDrivers()
+        self.assertTrue(waitFor(lambda: self.sets(node.address)))
+        self.assertIn((node.address, 'ST', 100), self.sets(node.address))
+
+    def test_dead_worker_is_restarted_with_its_values(self):
+        node = self.nodes[0]
+        shard = node.shard
+        pid = shard.process.pid
+        self.transport.deliver({'command': [{'address': node.address, 'command': 'DON'}]})
+        self.assertTrue(waitFor(lambda: node.drivers[0]['value'] == 100))
+        shard.process.kill()
+        self.assertTrue(waitFor(lambda: shard.stats['restarts'] == 1 and shard.alive(), 20))
+        self.assertNotEqual(shard.process.pid, pid)
+        # start() runs again in the new worker once the node is recreated
+        self.assertTrue(waitFor(lambda: (node.address, 'GV0', str(shard.process.pid)) in self.sets(), 20))
+        del self.published[:]
+        node.reportDrivers()
+        self.assertTrue(waitFor(lambda: self.sets(node.address)))
+        self.assertIn((node.address, 'ST', 100), self.sets(node.address))
+
+    def test_input_survives_a_dead_worker(self):
+        self.controller.SHARD_RESTART = False
+        node = self.nodes[0]
+        node.shard.process.kill()
+        self.assertTrue(waitFor(lambda: node.shard.dead))
+        self.transport.deliver({'command': [{'address': node.address, 'command': 'DON'}]})
+        self.transport.deliver({'query': {'address': 'controller'}})
+        self.assertTrue(waitFor(lambda: self.poly.inQueue.empty()))
+        self.assertTrue(self.controller._threads['input'].is_alive())
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,9 +1,8 @@
 #!/bin/sh -x
 
-# Doesn't work currently due to new PG3INIT variable requirement
-exit 0
-
+PG3_TEST_DIR=$(mktemp -d)
+export PG3_TEST_DIR
 python scripts/tests.py
 st=$?
-cat logs/debug.log
+cat $PG3_TEST_DIR/logs/debug.log
 exit $st